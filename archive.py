@@ -0,0 +1,370 @@
+from constants import ARCHIVES_DIR_NAME, ARCHIVE_CHUNK_SIZE, ARCHIVE_INDEX_SUFFIX, ARCHIVE_INDEX_VERSION, COMPRESSION_XZ, GZIP_LEVEL, XZ_PRESET, COPY_BUF_SIZE
+from error import Error
+from colors import Colors
+from hashing import ensure_regular
+
+from typing import Generator
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Executor, Future
+from hashlib import sha256
+from json import load, dump, JSONDecodeError
+from os import stat_result, makedirs, replace, listdir, unlink, chmod, utime
+from os.path import join
+from stat import S_IMODE
+from tarfile import TarInfo, REGTYPE, DIRTYPE, SYMTYPE, PAX_FORMAT, BLOCKSIZE, RECORDSIZE
+from zlib import compressobj, decompress as gzip_decompress, error as GzipError, DEFLATED, MAX_WBITS
+from lzma import compress as xz_compress, decompress as xz_decompress, LZMAError, FORMAT_XZ
+from datetime import datetime, timezone
+
+_GZIP_WBITS = MAX_WBITS | 16 # With a gzip header and trailer, so every chunk is a complete gzip member
+
+def compress_chunk(data: bytes, compression: str) -> bytes:
+    """ Compress a chunk of a tar stream on its own. Concatenated compressed chunks form a regular .tar.gz or .tar.xz file.
+
+    Kept at module level so it can be sent to worker processes. """
+
+    if compression == COMPRESSION_XZ:
+        return xz_compress(data, FORMAT_XZ, preset=XZ_PRESET)
+
+    compressor = compressobj(GZIP_LEVEL, DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress_chunk(data: bytes, compression: str) -> bytes:
+    """ Kept at module level so it can be sent to worker processes. """
+
+    if compression == COMPRESSION_XZ:
+        return xz_decompress(data, FORMAT_XZ)
+
+    return gzip_decompress(data, _GZIP_WBITS)
+
+def archive_directory(destination: str, source: str) -> str:
+    """ Return the directory holding the archives of a rule, named after a hash of the rule's source. """
+
+    return join(destination, ARCHIVES_DIR_NAME, sha256(source.encode()).hexdigest()[:16])
+
+def latest_index(destination: str, source: str) -> str | None | Error:
+    """ Return the index path of the most recent complete archive of a rule, `None` if there is none, otherwise an `Error` object. """
+
+    directory = archive_directory(destination, source)
+    try:
+        names = sorted(name for name in listdir(directory) if name.endswith(ARCHIVE_INDEX_SUFFIX))
+    except FileNotFoundError:
+        return None
+    except OSError as exc:
+        return Error(f"{Colors.BRIGHT_RED}Unable to list archives in '{directory}' due to error:\n{exc}{Colors.RESET}", exc)
+
+    return join(directory, names[-1]) if names else None
+
+class ArchiveWriter:
+    """ Streaming writer of a compressed tar archive and the index of its members.
+
+    The tar stream is cut in chunks of `ARCHIVE_CHUNK_SIZE` that are compressed independently on an executor, usually a process pool,
+    while the next members are read. Compressed chunks are written in order, so the archive is a plain .tar.gz or .tar.xz file that `tar` can extract.
+    The index records where each chunk starts in the tar stream and in the archive, and the offset, size and SHA-256 digest of each member's data,
+    so a single member can be read back by decompressing only the chunks holding it.
+
+    The archive is written under a temporary name and renamed once complete, then the index is written next to it. An archive without index is incomplete. """
+
+    def __init__(self, destination: str, source: str, compression: str, executor: Executor, max_pending: int) -> None:
+        name = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+
+        self.source = source
+        self.compression = compression
+        self.directory = archive_directory(destination, source)
+        self.path = join(self.directory, f"{name}.tar.{'xz' if compression == COMPRESSION_XZ else 'gz'}")
+        self.index_path = f"{self.path}{ARCHIVE_INDEX_SUFFIX}"
+        self.members: dict[str, list] = {} # Relative path -> [size, mtime_ns, inode, mode, digest, data offset in the tar stream]
+        self.chunks: list[list[int]] = [] # [offset in the tar stream, offset in the archive, compressed size]
+        self.size = 0 # Bytes of the tar stream so far
+        self.written = 0 # Compressed bytes written to the archive so far
+        self.error: OSError | None = None # Failure to compress or write, after which the archive cannot be completed
+
+        self._executor = executor
+        self._max_pending = max(1, max_pending)
+        self._pending: deque[tuple[int, Future]] = deque()
+        self._buffer = bytearray()
+        self._chunk_offset = 0
+        self._file = None
+
+    def open(self) -> None:
+        """ Start writing the archive. Temporary files of interrupted runs are removed, their archives can never be completed. """
+
+        makedirs(self.directory, exist_ok=True)
+        for name in listdir(self.directory):
+            if name.endswith(".tmp"):
+                unlink(join(self.directory, name))
+
+        self._file = open(f"{self.path}.tmp", "wb")
+
+    def _write_chunk(self) -> None:
+        """ Write the oldest compressed chunk to the archive, waiting for it if needed. """
+
+        offset, future = self._pending.popleft()
+        try:
+            data = future.result()
+            self._file.write(data)
+        except OSError as exc:
+            self.error = exc
+            raise
+        except Exception as exc: # A broken worker pool or a compressor failure
+            self.error = OSError(f"Unable to compress archive data: {exc}")
+            raise self.error from exc
+
+        self.chunks.append([offset, self.written, len(data)])
+        self.written += len(data)
+
+    def _submit(self, chunk: bytes) -> None:
+        self._pending.append((self._chunk_offset, self._executor.submit(compress_chunk, chunk, self.compression)))
+        self._chunk_offset += len(chunk)
+
+        while len(self._pending) > self._max_pending: # Bounds memory when compression is slower than reading
+            self._write_chunk()
+
+    def _write(self, data: bytes | memoryview) -> None:
+        self._buffer += data
+        self.size += len(data)
+
+        while len(self._buffer) >= ARCHIVE_CHUNK_SIZE:
+            self._submit(bytes(self._buffer[:ARCHIVE_CHUNK_SIZE]))
+            del self._buffer[:ARCHIVE_CHUNK_SIZE]
+
+    def _pad(self, size: int) -> None:
+        """ Pad the stream with NUL bytes up to the next multiple of size. """
+
+        remainder = self.size % size
+        if remainder:
+            self._write(bytes(size - remainder))
+
+    def _add_member(self, relative: str, st: stat_result, type: bytes, size: int=0, linkname: str="") -> None:
+        info = TarInfo(relative)
+        info.type = type
+        info.size = size
+        info.linkname = linkname
+        info.mode = S_IMODE(st.st_mode)
+        info.mtime = st.st_mtime_ns // 1_000_000_000
+        info.uid, info.gid = st.st_uid, st.st_gid
+
+        self._write(info.tobuf(PAX_FORMAT, "utf-8", "surrogateescape"))
+
+    def add_directory(self, relative: str, st: stat_result) -> None:
+        self._add_member(relative, st, DIRTYPE)
+
+    def add_symlink(self, relative: str, target: str, st: stat_result) -> None:
+        self._add_member(relative, st, SYMTYPE, linkname=target)
+
+    def add_file(self, relative: str, src: str, st: stat_result) -> None:
+        """ Append a regular file, reading exactly the size it had when it was scanned, and index it.
+
+        Failures to write the archive are also kept in `error`, the archive cannot be completed after them.
+        If the file cannot be read in full, the rest of the member is filled with NUL bytes so the stream stays valid,
+        the member is left out of the index and the error is raised. A later member with the same name takes precedence when extracting.
+        Named pipes, devices and sockets raise `shutil.SpecialFileError` without being opened or added. """
+
+        if self.error is not None:
+            raise self.error
+
+        ensure_regular(src, st.st_mode)
+        with open(src, "rb") as f:
+            self._add_member(relative, st, REGTYPE, st.st_size)
+            offset = self.size
+            file_hash = sha256()
+            remaining = st.st_size
+            error = None
+
+            while remaining:
+                try:
+                    data = f.read(min(COPY_BUF_SIZE, remaining))
+                except OSError as exc:
+                    error = exc
+                    break
+
+                if not data:
+                    error = OSError(f"{src} shrank while being archived")
+                    break
+
+                file_hash.update(data)
+                self._write(data)
+                remaining -= len(data)
+
+            if remaining:
+                self._write(bytes(remaining))
+
+            self._pad(BLOCKSIZE)
+
+        if error is not None:
+            raise error
+
+        self.members[relative] = [st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode, file_hash.hexdigest(), offset]
+
+    def close(self) -> str | Error:
+        """ End the tar stream, write the remaining chunks, then move the archive in place and write its index.
+
+        Return the archive path on success, otherwise an `Error` object. """
+
+        try:
+            if self.error is not None:
+                raise self.error
+
+            self._write(bytes(2 * BLOCKSIZE)) # End of archive marker
+            self._pad(RECORDSIZE)
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+
+            while self._pending:
+                self._write_chunk()
+
+            self._file.close()
+            replace(f"{self.path}.tmp", self.path)
+
+            content = {"version": ARCHIVE_INDEX_VERSION, "source": self.source, "compression": self.compression, "chunks": self.chunks, "members": self.members}
+            with open(f"{self.index_path}.tmp", "w") as f:
+                dump(content, f, separators=(",", ":"))
+
+            replace(f"{self.index_path}.tmp", self.index_path)
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to write archive '{self.path}' due to error:\n{exc}{Colors.RESET}", exc)
+
+        return self.path
+
+    def abort(self) -> None:
+        """ Discard an archive that will not be completed. """
+
+        for _, future in self._pending:
+            future.cancel()
+
+        try:
+            self._file.close()
+            unlink(f"{self.path}.tmp")
+        except (OSError, AttributeError):
+            pass
+
+class ArchiveReader:
+    """ Random access to the members of an archive through its index. """
+
+    def __init__(self, index_path: str, content: dict) -> None:
+        self.path = index_path[:-len(ARCHIVE_INDEX_SUFFIX)]
+        self.compression: str = content["compression"]
+        self.chunks: list[list[int]] = content["chunks"]
+        self.members: dict[str, list] = content["members"]
+        self._offsets = [chunk[0] for chunk in self.chunks]
+
+    @classmethod
+    def open(cls, index_path: str) -> "ArchiveReader | Error":
+        """ Load the index of an archive.
+
+        Return a reader on success, otherwise an `Error` object. """
+
+        try:
+            with open(index_path) as f:
+                content = load(f)
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to open archive index '{index_path}' due to error:\n{exc}{Colors.RESET}", exc)
+        except JSONDecodeError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to parse archive index '{index_path}' due to error:\n{exc}{Colors.RESET}", exc)
+
+        if not isinstance(content, dict) or content.get("version") != ARCHIVE_INDEX_VERSION or not isinstance(content.get("members"), dict) or not isinstance(content.get("chunks"), list):
+            return Error(f"{Colors.BRIGHT_RED}Archive index '{index_path}' has an unsupported structure.{Colors.RESET}")
+
+        return cls(index_path, content)
+
+    def _decompressed(self, future: Future, offset: int) -> bytes:
+        try:
+            return future.result()
+        except (GzipError, LZMAError, EOFError) as exc:
+            raise OSError(f"Chunk starting at byte {offset} of the tar stream in archive {self.path} is corrupt: {exc}") from exc
+
+    def read(self, relative: str) -> Generator[bytes, None, None]:
+        """ Yield the data of a member, decompressing only the chunks holding it. Raises `KeyError` for unknown members. """
+
+        size, *_, position = self.members[relative]
+        end = position + size
+        i = bisect_right(self._offsets, position) - 1
+
+        with open(self.path, "rb") as f:
+            while position < end:
+                chunk_offset, offset, compressed_size = self.chunks[i]
+                f.seek(offset)
+                data = decompress_chunk(f.read(compressed_size), self.compression)
+
+                piece = data[position - chunk_offset:end - chunk_offset]
+                if not piece:
+                    raise OSError(f"Archive {self.path} ends before member {relative}")
+
+                yield piece
+                position += len(piece)
+                i += 1
+
+    def extract(self, relative: str, dst: str) -> bool:
+        """ Restore a member to dst with its mode and modification time.
+
+        Return whether the restored data matches the digest in the index. """
+
+        file_hash = sha256()
+        with open(dst, "wb") as f:
+            for piece in self.read(relative):
+                file_hash.update(piece)
+                f.write(piece)
+
+        _, mtime_ns, _, mode, digest, _ = self.members[relative]
+        chmod(dst, S_IMODE(mode))
+        utime(dst, ns=(mtime_ns, mtime_ns))
+
+        return file_hash.hexdigest() == digest
+
+    def _chunks(self, executor: Executor, prefetch: int) -> Generator[tuple[int, bytes], None, None]:
+        """ Yield every chunk's offset in the tar stream and its data, in order, decompressing up to prefetch chunks ahead on the executor. """
+
+        pending: deque[tuple[int, Future]] = deque()
+        with open(self.path, "rb") as f:
+            for chunk_offset, offset, compressed_size in self.chunks:
+                f.seek(offset)
+                pending.append((chunk_offset, executor.submit(decompress_chunk, f.read(compressed_size), self.compression)))
+
+                if len(pending) > prefetch:
+                    chunk_offset, future = pending.popleft()
+                    yield chunk_offset, self._decompressed(future, chunk_offset)
+
+        while pending:
+            chunk_offset, future = pending.popleft()
+            yield chunk_offset, self._decompressed(future, chunk_offset)
+
+    def verify(self, executor: Executor, prefetch: int) -> Generator[tuple[str, int, bool], None, None]:
+        """ Decompress the whole archive once and check every member's data against the digest in the index.
+
+        Yield a (relative path, size, matched) tuple per member, in archive order. Raises `OSError` if the archive cannot be read. """
+
+        members = sorted((entry[5], entry[0], relative, entry[4]) for relative, entry in self.members.items())
+        i = 0
+        file_hash = None
+        position = end = 0
+
+        for chunk_offset, data in self._chunks(executor, prefetch):
+            view = memoryview(data)
+            chunk_end = chunk_offset + len(data)
+
+            while True:
+                if file_hash is None:
+                    if i == len(members) or members[i][0] >= chunk_end:
+                        break
+
+                    position, size, relative, digest = members[i]
+                    end = position + size
+                    file_hash = sha256()
+                    i += 1
+
+                stop = min(end, chunk_end)
+                file_hash.update(view[position - chunk_offset:stop - chunk_offset])
+                position = stop
+                if position < end:
+                    break
+
+                yield relative, size, file_hash.hexdigest() == digest
+                file_hash = None
+
+        if file_hash is not None: # Truncated archive
+            yield relative, size, False
+
+        for _, size, relative, _ in members[i:]:
+            yield relative, size, False
@@ -1,19 +1,14 @@
-from constants import RULES_JSON_PATH
+from constants import RULES_JSON_PATH, HASH_CACHE_PATH, HASH_ALGORITHMS, METRICS_FORMATS, METRICS_FORMAT_JSONL, FORMAT_ARCHIVE, WATCH_DEBOUNCE, WATCH_MAX_DELAY, SYNC_MODES, DEFAULT_SYNC_MODE, DEFAULT_VERIFY_WORKERS, DEFAULT_COPY_WORKERS, DEFAULT_COPY_WORKERS_PER_DEVICE, DEFAULT_COMPRESS_WORKERS
 from backupmanager import BackupManager
 from rulesparser import RulesParser, Rule
+from watcher import SourceWatcher, SUPPORTS_INOTIFY
 from error import Error
 from colors import Colors, all_colors
-from logutils import log
+from logutils import DEBUG, log, set_level
 
 from argparse import ArgumentParser, Namespace
 from sys import exit as sysexit
 
-try:
-    from os import sync
-    _SUPPORTS_FS_SYNC = True
-except ImportError:
-    _SUPPORTS_FS_SYNC = False
-
 from time import sleep
 from random import choice
 
@@ -32,31 +27,40 @@ def _ask(prompt: str) -> bool:
             log(f"{Colors.BRIGHT_RED}Abort.{Colors.RESET}")
             return False
 
-def _show_changes(backup_manager: BackupManager) -> bool:
-    """ Print the changes that will be applied to the disks and wait for input from the user. """
+def _show_changes(backup_manager: BackupManager, interactive: bool) -> bool:
+    """ Print the changes that will be applied to the disks and wait for input from the user, unless running non-interactively. """
 
     log(backup_manager.get_changes())
+    if not interactive:
+        return True
+
     return _ask(f"{choice(all_colors)}Continue? (y/n){Colors.RESET}: ")
 
-def _do_copy(backup_manager: BackupManager, dry_run: bool, quiet: bool) -> bool:
+def _do_copy(backup_manager: BackupManager, dry_run: bool, quiet: bool, interactive: bool, paths: dict[Rule, set[str] | None] | None=None) -> bool:
     """ Do the copy process. """
 
     log(f"{choice(all_colors)}Now copying files..{Colors.RESET}", quiet)
 
-    ret = backup_manager.copy_files()
+    with backup_manager.metrics.phase("copy"):
+        ret = backup_manager.copy_files(paths)
+
     if isinstance(ret, Error):
         log(ret.msg)
         return False
 
     _, copied = ret
 
+    if backup_manager.copy_failures: # Reported, but the other files are still synced and verified
+        log(backup_manager.failure_report())
+
     log(f"{'[DRY RUN] Would have ' if dry_run else ''}{'s' if dry_run else 'S'}uccessfully copied {choice(all_colors)}{len(copied)}{Colors.RESET} directories.", quiet)
-    sleep(1)
+    if interactive:
+        sleep(1)
 
     return True
 
-def _do_sync(no_fs_sync: bool, dry_run: bool, quiet: bool) -> bool:
-    """ Do filesystem sync (POSIX only). """
+def _do_sync(backup_manager: BackupManager, no_fs_sync: bool, dry_run: bool, quiet: bool) -> bool:
+    """ Do filesystem sync (POSIX only). Files were already being synced while copying with the default sync mode, this waits for the rest. """
     
     if no_fs_sync:
         log(f"{choice(all_colors)}Skipped filesystem sync as per command line switch{Colors.RESET}", quiet)
@@ -67,18 +71,16 @@ def _do_sync(no_fs_sync: bool, dry_run: bool, quiet: bool) -> bool:
     
     log(f"{choice(all_colors)}Syncing filesystem..{Colors.RESET}", quiet)
     
-    if _SUPPORTS_FS_SYNC:
-        try:
-            sync() # Important to let all buffers get written before using them to compute the hashes
-        except Exception as e:
-            log(f"Syncing filesystem failed. Cannot proceed with hash verification. Your copy may not be fully written.\nErr: {e}")
-            return False
-    else:
-        log(f"Unable to sync filesystem. OS might not provide support for it, and hash verification might fail due to unwritten buffers.")
+    with backup_manager.metrics.phase("sync"):
+        ret = backup_manager.sync() # Important to let all buffers get written before using them to compute the hashes
+
+    if isinstance(ret, Error):
+        log(ret.msg)
+        return False
 
     return True
 
-def _do_hash_verification(backup_manager: BackupManager, no_hash_verification: bool, dry_run: bool, quiet: bool) -> bool:
+def _do_hash_verification(backup_manager: BackupManager, no_hash_verification: bool, dry_run: bool, quiet: bool, interactive: bool, rules: list[Rule] | None=None) -> bool:
     """ Do hash verification on the fresh copy of the files. """
     
     if no_hash_verification:
@@ -89,9 +91,11 @@ def _do_hash_verification(backup_manager: BackupManager, no_hash_verification: b
         return True
     
     log(f"{choice(all_colors)}Verifying hashes..{Colors.RESET}", quiet)
-    sleep(2)
+    if interactive:
+        sleep(2)
     
-    ret = backup_manager.verify_hashes()
+    with backup_manager.metrics.phase("verify"):
+        ret = backup_manager.verify_hashes(rules)
 
     if isinstance(ret, Error):
         log(ret.msg)
@@ -121,7 +125,75 @@ def _get_rules(rules_file_path: str | None=None) -> list[Rule] | None:
 
     return rules
 
+def _write_metrics(backup_manager: BackupManager, args: Namespace, success: bool) -> None:
+    """ Write the metrics of the run to the metrics file, if one was given. """
+
+    if not args.metrics_file:
+        return
+
+    backup_manager.metrics.set("run_success", int(success))
+    ret = backup_manager.metrics.write(args.metrics_file, args.metrics_format)
+    if isinstance(ret, Error):
+        log(ret.msg)
+
+def _start_watching(rules: list[Rule], args: Namespace) -> SourceWatcher | None:
+    """ Watch the sources of the rules that can be copied in part. Archives are always written whole, so archive rules are only copied by the first run. """
+
+    if not SUPPORTS_INOTIFY:
+        log(f"{Colors.BRIGHT_RED}Watching sources for changes requires inotify (Linux only).{Colors.RESET}")
+        return None
+
+    for rule in rules:
+        if rule.format == FORMAT_ARCHIVE:
+            log(f"{Colors.BRIGHT_YELLOW}WARNING: {rule.source} uses the archive format and will not be watched for changes.{Colors.RESET}")
+
+    watched = [rule for rule in rules if rule.format != FORMAT_ARCHIVE]
+    if not watched:
+        log(f"{Colors.BRIGHT_RED}No rule can be watched for changes.{Colors.RESET}")
+        return None
+
+    watcher = SourceWatcher(watched, args.no_follow_symlinks)
+    ret = watcher.start()
+    if isinstance(ret, Error):
+        log(ret.msg)
+        return None
+
+    return watcher
+
+def _watch(backup_manager: BackupManager, watcher: SourceWatcher, args: Namespace) -> None:
+    """ Copy, sync and verify the paths touched under the watched sources in debounced batches, until interrupted.
+
+    Only the touched paths are walked, copied and verified. Files that fail are reported and copied again when they next change. """
+
+    log(f"{choice(all_colors)}Watching {watcher.directories} directories of {len(watcher.rules)} rule(s) for changes. Press Ctrl+C to stop.{Colors.RESET}")
+
+    try:
+        while True:
+            batch = watcher.wait_batch(args.watch_debounce, WATCH_MAX_DELAY)
+            touched = sum(len(paths) for paths in batch.values() if paths is not None)
+            log(f"{choice(all_colors)}Copying {touched} changed path(s) of {len(batch)} rule(s){', and every file of rules that lost track of their changes' if None in batch.values() else ''}..{Colors.RESET}", args.quiet)
+
+            copied = _do_copy(backup_manager, False, True, False, batch)
+            success = (
+                copied
+                and _do_sync(backup_manager, args.no_fs_sync, False, True)
+                and _do_hash_verification(backup_manager, args.no_hash_verification, False, True, False, list(batch))
+            )
+
+            success = success and not backup_manager.copy_failures
+            if copied:
+                backup_manager.finish_run()
+
+            _write_metrics(backup_manager, args, success)
+    except KeyboardInterrupt:
+        log(f"{choice(all_colors)}Stopped watching.{Colors.RESET}")
+    finally:
+        watcher.close()
+
 def main(args: Namespace) -> None:
+    if args.verbose:
+        set_level(DEBUG)
+
     if args.dry_run:
         log(f"{choice(all_colors)}===DRY RUN==={Colors.RESET}")
 
@@ -129,15 +201,51 @@ def main(args: Namespace) -> None:
     if rules is None:
         sysexit(1)
 
-    backup_manager = BackupManager(args.dry_run, args.no_follow_symlinks, args.quiet, rules)
+    for rule in rules:
+        if args.incremental:
+            rule.incremental = True
+        if args.hash_algorithm is not None:
+            rule.hash_algorithm = args.hash_algorithm
+        if args.delta:
+            rule.delta = True
+        if args.prune:
+            rule.prune = True
+
+    if args.watch and args.dry_run:
+        log(f"{Colors.BRIGHT_RED}Watching sources cannot be combined with a dry run.{Colors.RESET}")
+        sysexit(1)
 
-    if not _show_changes(backup_manager):
+    backup_manager = BackupManager(args.dry_run, args.no_follow_symlinks, args.quiet, rules, args.verify_workers, args.verify_processes, args.hash_during_copy, args.copy_workers, args.copy_workers_per_device, None if args.no_hash_cache else args.hash_cache_file or HASH_CACHE_PATH, sync_mode=None if args.no_fs_sync or args.dry_run else args.sync_mode, compress_workers=args.compress_workers, hash_verification=not args.no_hash_verification)
+
+    interactive = not args.non_interactive
+
+    if not _show_changes(backup_manager, interactive):
         sysexit(0)
-    elif not _do_copy(backup_manager, args.dry_run, args.quiet):
-        sysexit(1)
-    elif not _do_sync(args.no_fs_sync, args.dry_run, args.quiet):
-        sysexit(1)
-    elif not _do_hash_verification(backup_manager, args.no_hash_verification, args.dry_run, args.quiet):
+
+    watcher = None
+    if args.watch: # Before the first run, so changes made while it copies are not missed
+        watcher = _start_watching(rules, args)
+        if watcher is None:
+            sysexit(1)
+
+    copied = _do_copy(backup_manager, args.dry_run, args.quiet, interactive)
+    success = (
+        copied
+        and _do_sync(backup_manager, args.no_fs_sync, args.dry_run, args.quiet)
+        and _do_hash_verification(backup_manager, args.no_hash_verification, args.dry_run, args.quiet, interactive)
+    )
+
+    success = success and not backup_manager.copy_failures
+    if copied: # Every file was gone through, even if some failed. Otherwise the next run resumes this one
+        backup_manager.finish_run()
+
+    _write_metrics(backup_manager, args, success)
+
+    if watcher is not None: # Files that failed are copied again when they next change
+        _watch(backup_manager, watcher, args)
+        sysexit(0)
+
+    if not success:
         sysexit(1)
 
     log("done")
@@ -151,19 +259,57 @@ if __name__ == "__main__":
 
         --no-hash-verification Disables the post-copy hash verification between source and destination files.
         --no-fs-sync Disables filesystem sync after copying files.
-        --dry-run Runs the program without making any changes. Useful to test configurations.
+        --sync-mode How written data is synced: files (only the files and directories written by the run), filesystem (every destination filesystem, Linux only) or global (every filesystem).
+        --dry-run Runs the program without making any changes and prints what a run would copy, with an estimated duration. Useful to test configurations.
         --no-follow-symlinks Copies symlinks as symlinks to the destination. This is not recommended for backups to external disks.
         --quiet Hides noisy output.
+        --verbose Logs every copied and verified file instead of a periodic progress summary.
         --rules-file Specifies which file to use as the 'rules file'. The chosen file must be a JSON file following the example structure.
+        --verify-workers Number of files hashed at the same time during hash verification.
+        --verify-processes Hashes files on a process pool instead of a thread pool.
+        --copy-workers Number of files copied at the same time across all devices.
+        --copy-workers-per-device Number of files copied at the same time between the same source and destination devices. Use 1 for spinning disks.
+        --compress-workers Number of processes compressing and decompressing the data of archive rules.
+        --hash-algorithm Hash algorithm used for verification by every rule: sha256, blake2b or sampled. Overrides the rules' 'hash' property.
+        --no-hash-cache Disables the persistent cache of source file hashes used by hash verification.
+        --hash-cache-file Specifies which SQLite file to use as the hash cache.
+        --hash-during-copy Computes source hashes while copying, so hash verification only reads the destination files.
+        --incremental Skips files that did not change since the last run for every rule. Same as setting "incremental" to true in each rule.
+        --delta Only rewrites the changed blocks of large files for every rule. Same as setting "delta" to true in each rule.
+        --prune Deletes destination files whose source was deleted for every rule. Same as setting "prune" to true in each rule.
+        --watch After a first run, keeps watching the rules' sources (Linux only) and copies and verifies the changed files shortly after they change, until interrupted. Archive rules are not watched.
+        --watch-debounce Seconds without changes before the changed files are copied in watch mode.
+        --non-interactive Starts copying without asking for confirmation and without pauses between steps. Useful for scheduled jobs.
+        --metrics-file Writes timings and counters of every phase to the given file.
+        --metrics-format Format of the metrics file: jsonl (appended, one object per sample) or prometheus (textfile collector format).
         """,
         allow_abbrev=False
     )
     argparser.add_argument("--no-hash-verification", action="store_true")
     argparser.add_argument("--no-fs-sync", action="store_true")
+    argparser.add_argument("--sync-mode", choices=SYNC_MODES, default=DEFAULT_SYNC_MODE)
     argparser.add_argument("--dry-run", action="store_true")
     argparser.add_argument("--no-follow-symlinks", action="store_true")
     argparser.add_argument("--quiet", action="store_true")
+    argparser.add_argument("--verbose", action="store_true")
     argparser.add_argument("--rules-file")
+    argparser.add_argument("--incremental", action="store_true")
+    argparser.add_argument("--delta", action="store_true")
+    argparser.add_argument("--prune", action="store_true")
+    argparser.add_argument("--verify-workers", type=int, default=DEFAULT_VERIFY_WORKERS)
+    argparser.add_argument("--verify-processes", action="store_true")
+    argparser.add_argument("--hash-during-copy", action="store_true")
+    argparser.add_argument("--hash-algorithm", choices=HASH_ALGORITHMS)
+    argparser.add_argument("--no-hash-cache", action="store_true")
+    argparser.add_argument("--hash-cache-file")
+    argparser.add_argument("--copy-workers", type=int, default=DEFAULT_COPY_WORKERS)
+    argparser.add_argument("--copy-workers-per-device", type=int, default=DEFAULT_COPY_WORKERS_PER_DEVICE)
+    argparser.add_argument("--compress-workers", type=int, default=DEFAULT_COMPRESS_WORKERS)
+    argparser.add_argument("--watch", action="store_true")
+    argparser.add_argument("--watch-debounce", type=float, default=WATCH_DEBOUNCE)
+    argparser.add_argument("--non-interactive", action="store_true")
+    argparser.add_argument("--metrics-file")
+    argparser.add_argument("--metrics-format", choices=METRICS_FORMATS, default=METRICS_FORMAT_JSONL)
     args = argparser.parse_args()
 
     main(args)
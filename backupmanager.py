@@ -1,30 +1,289 @@
-from constants import FILE_BUF_SIZE
+from constants import DELTA_MIN_SIZE, SYNC_FILES, SYNC_FILESYSTEM, SYNC_GLOBAL, DEFAULT_SYNC_MODE, DEFAULT_SYNC_WORKERS, TEMP_SUFFIX, PARTIAL_SUFFIX, PRUNE_BATCH_SIZE, PRUNE_WORKERS, COPY_RETRIES, COPY_RETRY_DELAY, FORMAT_MIRROR, FORMAT_STORE, FORMAT_ARCHIVE, DEFAULT_COMPRESS_WORKERS, HASH_SHA256, HASH_SAMPLED, DEFAULT_HASH_ALGORITHM, HASH_CACHE_MAX_ENTRIES, DEFAULT_VERIFY_WORKERS, DEFAULT_COPY_WORKERS, DEFAULT_COPY_WORKERS_PER_DEVICE, COPY_BUF_SIZE, LARGE_FILE_THRESHOLD, COPY_CHUNK_SIZE
 from error import Error
 from rulesparser import Rule
+from matcher import IgnoreMatcher
+from manifest import Manifest
+from verifier import HashVerifier, VerificationResult
+from hashing import copy_and_hash, ensure_regular
+from scheduler import CopyScheduler
+from scanindex import ScanIndex
+from walker import walk, walk_paths
+from store import ObjectStore, Snapshot
+from hashcache import HashCache, SUPPORTS_HASH_CACHE
+from journal import Journal
+from delta import delta_copy, block_map_path
+from prune import stale_entries, stale_temp_files, remove_entry, remove_path, is_own_file
+from archive import ArchiveWriter, ArchiveReader, latest_index
+from history import History
+from planner import TransferPlan, NEW, CHANGED, UNCHANGED
+from durability import FileSyncer, datasync, SUPPORTS_SYNCFS, SUPPORTS_GLOBAL_SYNC, sync_filesystems, sync_all
+from metrics import Metrics, size_bucket
 from colors import Colors, all_colors
-from logutils import log
+from logutils import Progress, log, debug, format_size, format_duration
 
 from typing import Generator
-from hashlib import sha256
-from fnmatch import fnmatch
-from os import scandir
-from os.path import relpath, basename, join
-from shutil import copy2, copytree, ignore_patterns, Error as shutilError
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from glob import escape, glob
+from errno import EXDEV, ENOSYS, EINVAL, EOPNOTSUPP, EPERM, EIO, EAGAIN, EBUSY, EINTR, ETIMEDOUT, ESTALE, ECONNRESET, ECONNABORTED
+from os import DirEntry, sep, stat, stat_result, fstat, makedirs, readlink, symlink, unlink, replace, ftruncate, lseek, pread, write, SEEK_SET
+from os import open as os_open, close as os_close, O_WRONLY, O_CREAT
+from os.path import relpath, basename, dirname, join, lexists, islink, isdir, isfile, getsize
+from shutil import copystat, Error as shutilError
 from random import choice
+from re import compile as re_compile, escape as re_escape
+from threading import Lock
+from time import perf_counter, sleep
 
-def _copy_impl(src: str, dst: str, quiet: bool) -> str:
-    log(f"Copying {choice(all_colors)}{src}{Colors.RESET} to {choice(all_colors)}{dst}{Colors.RESET}", quiet)
+try:
+    from os import copy_file_range
+    _SUPPORTS_COPY_FILE_RANGE = True
+except ImportError:
+    _SUPPORTS_COPY_FILE_RANGE = False
 
-    return copy2(src, dst)
+try:
+    from os import sendfile
+    _SUPPORTS_SENDFILE = True
+except ImportError:
+    _SUPPORTS_SENDFILE = False
+
+try:
+    from os import posix_fadvise, POSIX_FADV_SEQUENTIAL, POSIX_FADV_DONTNEED
+    _SUPPORTS_FADVISE = True
+except ImportError:
+    _SUPPORTS_FADVISE = False
+
+try:
+    from fcntl import ioctl
+    _SUPPORTS_IOCTL = True
+except ImportError:
+    _SUPPORTS_IOCTL = False
+
+_FICLONE = 0x40049409 # _IOW(0x94, 9, int) from linux/fs.h
+_FALLBACK_ERRNOS = {EXDEV, ENOSYS, EINVAL, EOPNOTSUPP, EPERM} # Syscall is not supported for this pair of files, try the next one
+_TRANSIENT_ERRNOS = {EIO, EAGAIN, EBUSY, EINTR, ETIMEDOUT, ESTALE, ECONNRESET, ECONNABORTED} # Worth retrying, mostly flaky disks and network mounts
+
+def _advise(fd: int, offset: int, length: int, advice: int) -> None:
+    """ Give the kernel a page cache hint. Hints are best effort. Callers must check `_SUPPORTS_FADVISE`. """
+
+    try:
+        posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+def _try_reflink(src_fd: int, dst_fd: int) -> bool:
+    """ Try to share the source's data blocks with the destination (copy-on-write clone). 
+    
+    Only works when both files live on the same filesystem and it supports reflinks (Btrfs, XFS, ...). """
+
+    if not _SUPPORTS_IOCTL:
+        return False
+
+    try:
+        ioctl(dst_fd, _FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int, count: int) -> None:
+    """ Copy count bytes starting at offset between two file descriptors. 
+    
+    Prefers `copy_file_range`, which stays in the kernel and can be offloaded to the storage, then `sendfile`, then a plain read/write loop. """
+
+    end = offset + count
+
+    if _SUPPORTS_COPY_FILE_RANGE:
+        try:
+            while offset < end:
+                copied = copy_file_range(src_fd, dst_fd, end - offset, offset, offset)
+                if not copied:
+                    return # Source got truncated while copying
+
+                offset += copied
+
+            return
+        except OSError as exc:
+            if exc.errno not in _FALLBACK_ERRNOS:
+                raise
+
+    if _SUPPORTS_SENDFILE:
+        try:
+            lseek(dst_fd, offset, SEEK_SET) # sendfile() writes at the destination's file position
+            while offset < end:
+                sent = sendfile(dst_fd, src_fd, offset, end - offset)
+                if not sent:
+                    return
+
+                offset += sent
+
+            return
+        except OSError as exc:
+            if exc.errno not in _FALLBACK_ERRNOS:
+                raise
+
+    lseek(dst_fd, offset, SEEK_SET)
+    while offset < end:
+        buf = pread(src_fd, min(COPY_BUF_SIZE, end - offset), offset)
+        if not buf:
+            return
+
+        view = memoryview(buf)
+        while view:
+            written = write(dst_fd, view)
+            view = view[written:]
+
+        offset += len(buf)
+
+def _temp_path(dst: str) -> str:
+    return join(dirname(dst), f".{basename(dst)}{TEMP_SUFFIX}")
+
+def _discard(path: str) -> None:
+    try:
+        unlink(path)
+    except OSError:
+        pass
+
+def _copy_large_file(src_fd: int, size: int, mtime_ns: int, dst: str) -> str:
+    """ Copy a large file in chunks to a partial file next to dst and return the partial file's path. The caller moves it in place.
+    
+    The partial file name encodes the source's size and mtime, so an interrupted copy of an unchanged source resumes from its last durable chunk.
+    Every chunk is synced before the next one is written, so only the last complete chunk of a partial may have been lost by a crash and it is copied again.
+    Copied chunks are dropped from the page cache to avoid evicting other workloads' data. """
+
+    name = basename(dst)
+    partial = join(dirname(dst), f".{name}.{size}-{mtime_ns}{PARTIAL_SUFFIX}")
+
+    own_partial = re_compile(rf"\.{re_escape(name)}\.\d+--?\d+{re_escape(PARTIAL_SUFFIX)}") # The glob also matches partials of files named "<name>.<anything>"
+    for stale in glob(join(escape(dirname(dst)), f".{escape(name)}.*{PARTIAL_SUFFIX}")): # Partials of older versions of the source can never be resumed
+        if stale != partial and own_partial.fullmatch(basename(stale)):
+            unlink(stale)
+
+    dst_fd = os_open(partial, O_WRONLY | O_CREAT, 0o600)
+    try:
+        if not _try_reflink(src_fd, dst_fd):
+            offset = max(fstat(dst_fd).st_size // COPY_CHUNK_SIZE - 1, 0) * COPY_CHUNK_SIZE
+            if _SUPPORTS_FADVISE:
+                _advise(src_fd, offset, 0, POSIX_FADV_SEQUENTIAL)
+
+            while offset < size:
+                count = min(COPY_CHUNK_SIZE, size - offset)
+                _copy_range(src_fd, dst_fd, offset, count)
+                datasync(dst_fd)
+
+                if _SUPPORTS_FADVISE:
+                    _advise(src_fd, offset, count, POSIX_FADV_DONTNEED)
+                    _advise(dst_fd, offset, count, POSIX_FADV_DONTNEED) # Written back by the sync above
+
+                offset += count
+
+            ftruncate(dst_fd, size) # A resumed partial may be longer than the source
+    finally:
+        os_close(dst_fd)
+
+    return partial
+
+def _kernel_copy(src: str, dst: str) -> str:
+    """ Copy file contents and metadata from src to dst like `shutil.copy2`, keeping the data inside the kernel where possible. 
+    
+    The data is written to a temporary file next to dst, which is atomically renamed once complete, so dst is never seen half written.
+
+    Return the destination path. """
+
+    with open(src, "rb") as src_f:
+        src_fd = src_f.fileno()
+        st = fstat(src_fd)
+
+        if st.st_size >= LARGE_FILE_THRESHOLD:
+            tmp = _copy_large_file(src_fd, st.st_size, st.st_mtime_ns, dst) # Kept on failure, to be resumed
+        else:
+            tmp = _temp_path(dst)
+            try:
+                with open(tmp, "wb") as dst_f:
+                    if not _try_reflink(src_fd, dst_f.fileno()):
+                        _copy_range(src_fd, dst_f.fileno(), 0, st.st_size)
+            except BaseException:
+                _discard(tmp)
+                raise
+
+    copystat(src, tmp)
+    replace(tmp, dst)
+
+    return dst
+
+def _forget(files: dict, relative: str) -> None:
+    """ Remove a relative path and every path under it from a mapping keyed by relative paths. """
+
+    prefix = join(relative, "")
+    for key in [key for key in files if key == relative or key.startswith(prefix)]:
+        del files[key]
+
+def _copy_impl(src: str, dst: str) -> str:
+    debug("Copying %s to %s", src, dst)
+
+    return _kernel_copy(src, dst)
+
+class _CopyState:
+    """ Bookkeeping of a rule while its files are being copied. """
+
+    def __init__(self, rule: Rule) -> None:
+        self.rule = rule
+        self.index = ScanIndex(rule.source)
+        self.manifest: Manifest | None = None
+        self.directories: list[tuple[str, str]] = [] # (source, destination) pairs in creation order
+        self.errors: list[tuple[str, str, str]] = [] # Same shape as `shutil.Error` arguments
+        self.walked = False
+        self.paths: set[str] | None = None # Only these paths of the source are copied, in watch mode
+        self.deleted: list[str] = [] # Paths that no longer exist in the source, in watch mode
+        self.error: Error | None = None
+        self.journal: Journal | None = None
+        self.started = perf_counter()
+        self.finished = self.started # When the walk or the last copy job of the rule ended
+        self.copied_files = 0
+        self.copied_bytes = 0 # Read from the source
+
+        # Only for rules using the store format
+        self.store: ObjectStore | None = None
+        self.snapshot: Snapshot | None = None
+        self.previous: dict[str, list] = {} # Files of the rule's previous snapshot
+        self.stored_files = 0
+        self.stored_bytes = 0
+        self.lock = Lock()
+
+        # Only for rules using the archive format
+        self.archive: ArchiveWriter | None = None
 
 class BackupManager:
     """ Backup manager object to handle core functions. """
 
-    def __init__(self, dry_run: bool, no_follow_symlinks: bool, quiet: bool, rules: list[Rule]) -> None:
+    def __init__(self, dry_run: bool, no_follow_symlinks: bool, quiet: bool, rules: list[Rule], verify_workers: int=DEFAULT_VERIFY_WORKERS, verify_processes: bool=False, hash_during_copy: bool=False, copy_workers: int=DEFAULT_COPY_WORKERS, copy_workers_per_device: int=DEFAULT_COPY_WORKERS_PER_DEVICE, hash_cache_path: str | None=None, metrics: Metrics | None=None, sync_mode: str | None=DEFAULT_SYNC_MODE, compress_workers: int=DEFAULT_COMPRESS_WORKERS, hash_verification: bool=True) -> None:
         self.dry_run = dry_run
         self.no_follow_symlinks = no_follow_symlinks
         self.quiet = quiet
         self.rules = rules
+        self.verify_workers = verify_workers
+        self.verify_processes = verify_processes
+        self.hash_during_copy = hash_during_copy
+        self.copy_workers = copy_workers
+        self.copy_workers_per_device = copy_workers_per_device
+        self.hash_cache_path = hash_cache_path # Disabled when None
+        self.metrics = metrics if metrics is not None else Metrics() # Counters and timings of every phase, labelled by rule destination
+        self.sync_mode = sync_mode # How `sync` makes written data durable, nothing is tracked when None
+        self.compress_workers = max(1, compress_workers) # Processes compressing and decompressing archive chunks
+        self.hash_verification = hash_verification # Only tells dry run plans whether to estimate verification
+
+        self.verification_failures: list[VerificationResult] = [] # Pairs that failed the last verification, matching pairs are not kept
+
+        self._manifests: dict[tuple[str, str], Manifest] = {} # Keyed by rule (source, destination), only for incremental rules
+        self._changed: dict[tuple[str, str], set[str]] = {} # Relative paths copied during this run, keyed by rule (source, destination)
+        self._source_digests: dict[str, str] = {} # Source hashes computed while copying, keyed by destination file path
+        self._indexes: dict[tuple[str, str], ScanIndex] = {} # Source scans made while copying, keyed by rule (source, destination)
+        self._store_objects: dict[tuple[str, str], set[str]] = {} # Digests of the objects read or written during this run, keyed by rule (source, destination), only for store rules
+        self._progress = Progress("", True) # Progress of the running phase
+        self._journals: dict[tuple[str, str], Journal] = {} # Journals of this run, keyed by rule (source, destination)
+        self._failed: dict[tuple[str, str], set[str]] = {} # Relative paths that could not be copied, keyed by rule (source, destination)
+        self._syncer: FileSyncer | None = None # Syncs written files while copying, only with the files sync mode
+        self._archives: dict[tuple[str, str], ArchiveWriter] = {} # Archives written during this run, keyed by rule (source, destination)
+
+        self.copy_failures: list[tuple[str, str, str]] = [] # (source, destination, error message) of every file that could not be copied
 
     def get_changes(self) -> str:
         """ Return a string containing all the rules' changes and their exclusions. """
@@ -38,158 +297,1147 @@ class BackupManager:
             string += f"{choice(all_colors)}{rule.destination} {Colors.RESET}"
             if rule.ignore:
                 string += f"{choice(all_colors)}(excluding {', '.join([excluded for excluded in rule.ignore])} files/folders){Colors.RESET}"
+            if rule.hash_algorithm != DEFAULT_HASH_ALGORITHM and rule.format == FORMAT_MIRROR:
+                string += f"{choice(all_colors)} ({rule.hash_algorithm} verification){Colors.RESET}"
+            if rule.format == FORMAT_STORE:
+                string += f"{choice(all_colors)} (content-addressed store){Colors.RESET}"
+            elif rule.format == FORMAT_ARCHIVE:
+                string += f"{choice(all_colors)} ({rule.compression} archive){Colors.RESET}"
+            elif rule.incremental:
+                string += f"{choice(all_colors)} (incremental){Colors.RESET}"
+            if rule.delta and rule.format == FORMAT_MIRROR:
+                string += f"{choice(all_colors)} (delta){Colors.RESET}"
+            if rule.prune and rule.format == FORMAT_MIRROR:
+                string += f"{choice(all_colors)} (pruning deleted files){Colors.RESET}"
             string += "\n"
 
         return string
 
-    def _do_copy_op(self, rule: Rule) -> str | Error:
-        """ Copy source to destination as specified by the rule argument. 
+    def _copy_file(self, src: str, dst: str, algorithm: str) -> str:
+        """ Copy a single file. With hash-during-copy enabled, the source hash is recorded so verification only has to read the destination. 
         
-        On success, return a path string of the copied directory, otherwise `Error` object. """
+        Sampled hashes cannot be computed while streaming, such files are copied normally. """
 
-        if self.dry_run:
-            log(f"{choice(all_colors)}[DRY RUN] Skipped copy of {rule.source} to {rule.destination} as per dry run flag{Colors.RESET}", self.quiet)
+        if not self.hash_during_copy or algorithm == HASH_SAMPLED:
+            _copy_impl(src, dst)
+        else:
+            debug("Copying %s to %s", src, dst)
+            tmp = _temp_path(dst)
+            try:
+                self._source_digests[dst] = copy_and_hash(src, tmp, algorithm)
+                replace(tmp, dst)
+            except BaseException:
+                _discard(tmp)
+                raise
+
+        if self._syncer is not None:
+            self._syncer.add(dst)
+
+        return dst
+
+    def _delta_copy(self, state: _CopyState, src: str, dst: str, relative: str, st: stat_result) -> int:
+        """ Rewrite only the changed blocks of an existing destination file. The file is updated in place, not renamed.
+
+        Return the number of bytes written. """
+
+        algorithm = state.rule.hash_algorithm
+        debug("Delta copying %s to %s", src, dst)
+        written, digest = delta_copy(src, dst, block_map_path(state.rule.destination, relative), algorithm if self.hash_during_copy and algorithm != HASH_SAMPLED else None)
+
+        if digest is not None:
+            self._source_digests[dst] = digest
+        if self._syncer is not None:
+            self._syncer.add(dst)
+
+        self.metrics.add("delta_files_total", rule=state.rule.destination)
+        self.metrics.add("delta_bytes_skipped_total", st.st_size - written, rule=state.rule.destination)
+
+        return written
+
+    def _write_file(self, state: _CopyState, src: str, dst: str, relative: str, st: stat_result) -> int:
+        """ Write a file of a mirror rule to its destination. Large files of delta rules that already exist there only get their changed blocks rewritten.
+
+        Return the number of bytes written. """
+
+        if state.rule.delta and st.st_size >= DELTA_MIN_SIZE and isfile(dst):
+            return self._delta_copy(state, src, dst, relative, st)
+
+        self._copy_file(src, dst, state.rule.hash_algorithm)
+        return st.st_size
+
+    def _resume(self, state: _CopyState, dst: str, relative: str, st: stat_result) -> bool:
+        """ Return whether the file was already copied by an interrupted run, from the same version of the source. """
+
+        if not state.journal.completed(relative, st) or not lexists(dst):
+            return False
+
+        self.metrics.add("files_resumed_total", rule=state.rule.destination)
+        return True
+
+    def _incremental_copy(self, state: _CopyState, src: str, dst: str, relative: str, st: stat_result) -> None:
+        """ Copy a file of an incremental rule. Files whose size, mtime and inode match their manifest entry are skipped without being opened. 
+        
+        The stat result is taken during the scan, before copying, so a file modified mid-copy is copied again on the next run. """
+
+        manifest = state.manifest
+
+        if manifest.is_unchanged(relative, st) and lexists(dst):
+            self.metrics.add("files_unchanged_total", rule=state.rule.destination)
+            return
+
+        if not self._resume(state, dst, relative, st):
+            written = self._write_file(state, src, dst, relative, st)
+            state.journal.record_copy(relative, st)
+            self._record_copy(state, st, written)
+
+        manifest.record(relative, st, self._source_digests.get(dst))
+        self._changed[(state.rule.source, state.rule.destination)].add(relative) # Resumed files too, they may not have been verified yet
+
+    def _store_copy(self, state: _CopyState, src: str, relative: str, st: stat_result) -> None:
+        """ Add a file to the rule's object store. Files unchanged since the previous snapshot reuse its objects without being opened,
+        unless one of them was removed for failing verification. """
+
+        previous = state.previous.get(relative)
+        if previous is not None and previous[:3] == [st.st_size, st.st_mtime_ns, st.st_ino] and all(state.store.has(digest) for digest in previous[5]):
+            state.snapshot.files[relative] = previous
+            self.metrics.add("files_unchanged_total", rule=state.rule.destination)
+            return
+
+        if state.journal.completed(relative, st) and all(state.store.has(digest) for digest in state.journal.payload(relative)[5]):
+            entry = state.journal.payload(relative)
+            state.snapshot.files[relative] = entry
+            self.metrics.add("files_resumed_total", rule=state.rule.destination)
+
+            with state.lock:
+                self._store_objects[(state.rule.source, state.rule.destination)].update(entry[5])
+
+            return
+
+        debug("Storing %s", src)
+        digest, chunks, written = state.store.store_file(src, self._syncer.add if self._syncer is not None else None)
+        state.snapshot.add(relative, st, digest, chunks)
+        state.journal.record_copy(relative, st, state.snapshot.files[relative])
+
+        with state.lock:
+            state.stored_files += 1
+            state.stored_bytes += written
+            self._store_objects[(state.rule.source, state.rule.destination)].update(chunks)
 
-            return rule.destination
+        self._record_copy(state, st, written)
+
+    def _archive_copy(self, state: _CopyState, src: str, relative: str, st: stat_result) -> None:
+        """ Append a file to the rule's archive. Only the compressed chunks completed meanwhile count as written. """
+
+        debug("Archiving %s", src)
+        written = state.archive.written
+        state.archive.add_file(relative, src, st)
+
+        self._record_copy(state, st, state.archive.written - written)
+
+    def _record_copy(self, state: _CopyState, st: stat_result, written: int) -> None:
+        """ Count a copied file and its bytes in the rule's size bucket. """
+
+        rule, bucket = state.rule.destination, size_bucket(st.st_size)
+        with state.lock:
+            state.copied_files += 1
+            state.copied_bytes += st.st_size
+
+        self.metrics.add("files_copied_total", rule=rule, size=bucket)
+        self.metrics.add("bytes_read_total", st.st_size, rule=rule, size=bucket)
+        self.metrics.add("bytes_written_total", written, rule=rule, size=bucket)
+
+    def _mirror_copy(self, state: _CopyState, src: str, dst: str, relative: str, st: stat_result) -> None:
+        if self._resume(state, dst, relative, st):
+            return
+
+        written = self._write_file(state, src, dst, relative, st)
+        state.journal.record_copy(relative, st)
+        self._record_copy(state, st, written)
+
+    def _copy_job(self, state: _CopyState, src: str, dst: str, relative: str, st: stat_result) -> None:
+        """ Copy a single file on a scheduler worker. 
+        
+        Transient errors are retried with an exponential backoff, other failures, unexpected exceptions included, are collected in the rule's copy state like `copytree` does.
+        Named pipes, devices and sockets are reported as failures without being opened, reading them could block forever. """
 
         try:
-            return copytree(
-                rule.source,
-                rule.destination,
-                symlinks=self.no_follow_symlinks, # 'symlinks' argument is basically the same as 'follow_symlinks', except that TRUE will NOT follow symlinks, but FALSE will for some reason
-                ignore=ignore_patterns(*rule.ignore) if rule.ignore else None,
-                copy_function=lambda src, dst: _copy_impl(src, dst, self.quiet),
-                dirs_exist_ok=True
-            )
-        except shutilError as exc:
-            error_msg = f"{Colors.BRIGHT_RED}Error(s) occurred while copying files.{Colors.RESET}\n"
-            for src, dst, msg in exc.args[0]:
-                error_msg += f"{Colors.BRIGHT_RED}Failed to copy {src} to {dst}. Err: {msg}{Colors.RESET}\n"
+            try:
+                ensure_regular(src, st.st_mode) # The scanned mode, before any open
+            except OSError as exc:
+                state.errors.append((src, dst, str(exc)))
+                return
+
+            for attempt in range(COPY_RETRIES + 1):
+                try:
+                    if state.archive is not None:
+                        self._archive_copy(state, src, relative, st)
+                    elif state.snapshot is not None:
+                        self._store_copy(state, src, relative, st)
+                    elif state.manifest is not None:
+                        self._incremental_copy(state, src, dst, relative, st)
+                    else:
+                        self._mirror_copy(state, src, dst, relative, st)
+
+                    return
+                except (OSError, shutilError) as exc:
+                    if attempt == COPY_RETRIES or exc.errno not in _TRANSIENT_ERRNOS:
+                        state.errors.append((src, dst, str(exc)))
+                        return
+
+                    self.metrics.add("copy_retries_total", rule=state.rule.destination)
+                    sleep(COPY_RETRY_DELAY * 2 ** attempt)
+                except Exception as exc: # A bug or a corrupt payload, retrying would fail the same way. The scheduler drops what a job raises
+                    state.errors.append((src, dst, f"{type(exc).__name__}: {exc}"))
+                    return
+        finally:
+            state.finished = perf_counter()
+            self._progress.update(st.st_size)
+
+    def _copy_symlink(self, state: _CopyState, src: str, dst: str) -> None:
+        """ Recreate the symlink at src as a symlink at dst. """
+
+        try:
+            if islink(dst):
+                unlink(dst) # An existing symlink is replaced, like any other file
             
-            return Error(error_msg, exc)
-        except OSError as exc: # handles copytree()'s makedirs() and scandir() function calls exceptions
-            return Error(f"{Colors.BRIGHT_RED}An error occurred while copying {rule.source} to {rule.destination}.\nErr: {exc}{Colors.RESET}", exc)
+            symlink(readlink(src), dst)
+            copystat(src, dst, follow_symlinks=False)
 
-    def copy_files(self) -> tuple[list[str], list[str]] | Error:
-        """ Copy all files from source to destination as defined in the rules file. 
+            if self._syncer is not None:
+                self._syncer.add_directory(dirname(dst))
+        except OSError as exc:
+            state.errors.append((src, dst, str(exc)))
+
+    def _do_copy_op(self, rule: Rule, scheduler: CopyScheduler, compressor: Executor | None=None, paths: set[str] | None=None) -> _CopyState | Error:
+        """ Walk the rule's source, create the destination directories and schedule a copy job for every file. 
         
-        Return a tuple with two lists containing source and copied directories' paths respectively. """
+        Files are grouped by their (source, destination) device pair so that each device gets its own concurrency limit.
+        Archives are a single stream, so files of archive rules are appended in walk order while their chunks are compressed on the compressor.
+        With paths, only those paths relative to the source and the trees of those that are directories are walked, the rest of the source is left as copied before.
 
-        source, copied = [], []
+        Return the rule's copy state, otherwise `Error` object if the source or destination could not be opened. """
 
-        for rule in self.rules:
-            ret = self._do_copy_op(rule)
+        state = _CopyState(rule)
+        state.paths = paths
+        store = rule.format == FORMAT_STORE
+        mirror = rule.format == FORMAT_MIRROR
+
+        if store:
+            state.store = ObjectStore(rule.destination)
+            state.snapshot = Snapshot(state.store, rule.source)
+            previous = state.snapshot.load_latest()
+            if isinstance(previous, Error):
+                return previous
 
+            state.previous = previous
+            if paths is not None: # Snapshots list the whole source, untouched files are carried over
+                state.snapshot.files = dict(previous)
+            self._store_objects[(rule.source, rule.destination)] = set()
+        elif rule.format == FORMAT_ARCHIVE:
+            state.archive = ArchiveWriter(rule.destination, rule.source, rule.compression, compressor, self.compress_workers * 2)
+        elif rule.incremental: # Snapshots already make store rules incremental, archives are always full
+            manifest = Manifest(rule.destination, rule.hash_algorithm)
+            ret = manifest.load()
             if isinstance(ret, Error):
                 return ret
-            
-            copied.append(ret)
-            source.append(rule.source)
 
-        return source, copied
-    
-    def _recurse_directory(self, path: str, ignore: list[str] | None=None, sort: bool=False) -> list[str] | Error:
-        """ Recurse into the given directory path and build a list of paths for all inner files. 
-        
-        Additionally, exclusions can be specified as glob patterns with the ignore argument. 
+            state.manifest = manifest
+            self._manifests[(rule.source, rule.destination)] = manifest
+            self._changed[(rule.source, rule.destination)] = set()
 
-        Return a list of string file paths, or an Error object on failure. """
-        
-        def _traverse_dir(current_path: str) -> list[str] | Error:
-            """ Traverse into the directory and collect all file paths inside of it. This is recursive. """
-            
-            files = []
+        journal = Journal(rule.destination, rule.source)
+        ret = journal.load()
+        if isinstance(ret, Error):
+            return ret
+
+        state.journal = journal
+        self._journals[(rule.source, rule.destination)] = journal
+        if journal.copied:
+            log(f"Resuming an interrupted run of {rule.source}, {choice(all_colors)}{len(journal.copied)}{Colors.RESET} files were already copied", self.quiet)
+
+        index = state.index
+
+        ignored = 0
+
+        def _on_walk_error(path: str, exc: OSError) -> None:
+            state.errors.append((path, join(rule.destination, relpath(path, rule.source)), str(exc)))
+
+        def _on_ignore(_) -> None:
+            nonlocal ignored
+            ignored += 1
+
+        def _on_missing(relative: str) -> None:
+            state.deleted.append(relative)
+
+        try:
+            makedirs(rule.destination, exist_ok=True)
+            dst_device = stat(rule.destination).st_dev
+            if state.archive is not None:
+                state.archive.open()
+                self._archives[(rule.source, rule.destination)] = state.archive
+            directories = {"": (index.add_directory(""), stat(rule.source).st_dev)} # Relative directory -> (index directory id, source device)
+            follow_symlinks = not self.no_follow_symlinks or store # The store only holds file data, symlinks are always followed
+            if mirror:
+                state.directories.append((rule.source, rule.destination))
+
+            if paths is None:
+                entries = walk(rule.source, rule.matcher, follow_symlinks, on_error=_on_walk_error, on_ignore=_on_ignore)
+            else:
+                entries = walk_paths(rule.source, paths, rule.matcher, follow_symlinks, on_error=_on_walk_error, on_missing=_on_missing)
+
+            for relative_dir, entry in entries:
+                relative = join(relative_dir, entry.name) if relative_dir else entry.name
+                src, dst = entry.path, join(rule.destination, relative)
+
+                try:
+                    if relative_dir not in directories: # Parent of a touched path, which was not walked
+                        directories[relative_dir] = (index.add_directory(relative_dir), stat(dirname(src)).st_dev)
+                        if mirror:
+                            state.directories.append((dirname(src), dirname(dst)))
+                            makedirs(dirname(dst), exist_ok=True)
+
+                    if entry.is_symlink() and not follow_symlinks and state.archive is not None:
+                        state.archive.add_symlink(relative, readlink(src), entry.stat(follow_symlinks=False))
+                    elif entry.is_symlink() and not follow_symlinks:
+                        self._copy_symlink(state, src, dst)
+                    elif entry.is_dir(): # Follows symlinks. The walker yields directories before their contents
+                        try:
+                            device = entry.stat().st_dev
+                        except OSError: # Its contents are still walked, and copied as if on the parent's device
+                            device = directories[relative_dir][1]
+
+                        directories[relative] = (index.add_directory(relative), device)
+
+                        if mirror:
+                            state.directories.append((src, dst))
+                            makedirs(dst, exist_ok=True)
+                        elif state.archive is not None:
+                            state.archive.add_directory(relative, entry.stat())
+                    else:
+                        directory_id, src_device = directories[relative_dir]
+                        st = entry.stat()
+                        index.add(directory_id, entry.name, st.st_size, st.st_mtime_ns)
+                        if state.archive is not None:
+                            self._copy_job(state, src, dst, relative, st)
+                        else:
+                            scheduler.submit((src_device, dst_device), self._copy_job, state, src, dst, relative, st)
+                except OSError as exc:
+                    state.errors.append((src, dst, str(exc)))
+
+                if state.archive is not None and state.archive.error is not None:
+                    raise state.archive.error
+        except OSError as exc: # makedirs(), stat() and scandir() exceptions on the rule's directories themselves, and archive write failures
+            if state.archive is not None:
+                state.archive.abort()
+                self._archives.pop((rule.source, rule.destination), None)
+
+            return Error(f"{Colors.BRIGHT_RED}An error occurred while copying {rule.source} to {rule.destination}.\nErr: {exc}{Colors.RESET}", exc)
+
+        state.walked = paths is None
+        self._indexes[(rule.source, rule.destination)] = index
+
+        # The walk blocks while the scheduler's queue is full, so the scan time includes time spent waiting for copies
+        walked = perf_counter()
+        state.finished = max(state.finished, walked)
+        self.metrics.set("phase_seconds", walked - state.started, phase="scan", rule=rule.destination)
+        self.metrics.add("files_scanned_total", len(index), rule=rule.destination)
+        self.metrics.add("bytes_scanned_total", index.total_size, rule=rule.destination)
+        self.metrics.add("ignored_entries_total", ignored, rule=rule.destination)
+
+        return state
+
+    def _discard_block_maps(self, rule: Rule, path: str, is_dir: bool) -> None:
+        """ Remove the delta block maps of a destination file about to be pruned, or of every file under a directory about to be pruned.
+
+        Maps are named after a hash of their file's path, so the directory has to be walked before it is removed. A map left behind is only wasted space. """
+
+        if not is_dir:
+            _discard(block_map_path(rule.destination, relpath(path, rule.destination)))
+            return
+
+        try:
+            for _, entry in walk(path, follow_symlinks=False, on_error=lambda *_: None):
+                if not entry.is_dir(follow_symlinks=False):
+                    _discard(block_map_path(rule.destination, relpath(entry.path, rule.destination)))
+        except OSError:
+            pass
+
+    def _prune(self, rule: Rule) -> None:
+        """ Remove the entries of a mirror rule's destination whose source was deleted. With dry run, only log them.
+
+        Stale entries are found while the destination is walked and removed in batches of `PRUNE_BATCH_SIZE` on a small thread pool, so removals overlap the walk.
+        Entries that could not be removed are only reported, they are tried again on the next run. """
+
+        started = perf_counter()
+        found = 0
+        failures: list[tuple[str, OSError]] = []
+
+        def _remove_batch(entries: list[DirEntry]) -> int:
+            removed = 0
+            for entry in entries:
+                if rule.delta:
+                    self._discard_block_maps(rule, entry.path, entry.is_dir(follow_symlinks=False))
+
+                try:
+                    remove_entry(entry)
+                    removed += 1
+                except OSError as exc:
+                    failures.append((entry.path, exc))
+
+            return removed
+
+        def _on_walk_error(path: str, exc: OSError) -> None:
+            failures.append((path, exc))
+
+        batch: list[DirEntry] = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=PRUNE_WORKERS, thread_name_prefix="prune") as executor:
+            try:
+                for entry in stale_entries(rule.source, rule.destination, rule.matcher, not self.no_follow_symlinks, _on_walk_error):
+                    found += 1
+                    if self.dry_run:
+                        log(f"{choice(all_colors)}[DRY RUN] Would delete {entry.path}{'/' if entry.is_dir(follow_symlinks=False) else ''}{Colors.RESET}", self.quiet)
+                        continue
+
+                    debug("Deleting %s", entry.path)
+                    batch.append(entry)
+                    if len(batch) >= PRUNE_BATCH_SIZE:
+                        futures.append(executor.submit(_remove_batch, batch))
+                        batch = []
+
+                if batch:
+                    futures.append(executor.submit(_remove_batch, batch))
+            except OSError as exc: # The source changed while being walked, the rest of the destination is left as is
+                failures.append((rule.source, exc))
+
+        self.metrics.set("phase_seconds", perf_counter() - started, phase="prune", rule=rule.destination)
+        removed = sum(future.result() for future in futures)
+        self.metrics.add("entries_pruned_total", removed, rule=rule.destination)
+
+        log(f"{'[DRY RUN] Would have deleted' if self.dry_run else 'Deleted'} {choice(all_colors)}{found if self.dry_run else removed}{Colors.RESET} entries of {rule.destination} that no longer exist in {rule.source}", self.quiet or not found)
+        for path, exc in failures:
+            log(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to prune {path}.\nErr: {exc}{Colors.RESET}")
+
+    def _remove_deleted(self, state: _CopyState) -> None:
+        """ Forget the touched paths of a rule that no longer exist in its source, and remove their destination counterparts if the rule prunes a mirror. """
+
+        rule = state.rule
+        removed = 0
+
+        for relative in state.deleted:
+            if state.snapshot is not None:
+                _forget(state.snapshot.files, relative)
+            if state.manifest is not None:
+                _forget(state.manifest.entries, relative)
+
+            dst = join(rule.destination, relative)
+            if not (rule.prune and rule.format == FORMAT_MIRROR) or is_own_file(tuple(relative.split(sep))) or not lexists(dst):
+                continue
+
+            debug("Deleting %s", dst)
+            if rule.delta:
+                self._discard_block_maps(rule, dst, isdir(dst) and not islink(dst))
+
+            try:
+                remove_path(dst)
+            except OSError as exc:
+                log(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to prune {dst}.\nErr: {exc}{Colors.RESET}")
+                continue
+
+            removed += 1
+
+        self.metrics.add("entries_pruned_total", removed, rule=rule.destination)
+        log(f"Deleted {choice(all_colors)}{removed}{Colors.RESET} entries of {rule.destination} that no longer exist in {rule.source}", self.quiet or not removed)
+
+    def _sweep_temp_files(self, rule: Rule) -> None:
+        """ Remove the temporary and partial files an interrupted run left in a mirror rule's destination for files that no longer exist in its source.
+
+        Those of files that still exist are replaced or resumed by the next copy of the file. Files that could not be removed are only reported. """
+
+        removed = 0
+
+        def _on_walk_error(path: str, exc: OSError) -> None:
+            log(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to look for leftover temporary files in {path}.\nErr: {exc}{Colors.RESET}")
+
+        try:
+            for path in stale_temp_files(rule.source, rule.destination, rule.matcher, _on_walk_error):
+                debug("Deleting leftover %s", path)
+                try:
+                    unlink(path)
+                    removed += 1
+                except OSError as exc:
+                    log(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to remove leftover temporary file {path}.\nErr: {exc}{Colors.RESET}")
+        except OSError as exc:
+            _on_walk_error(rule.destination, exc)
+
+        log(f"Removed {choice(all_colors)}{removed}{Colors.RESET} temporary files left in {rule.destination} by an interrupted run", self.quiet or not removed)
+
+    def _finish_copy_op(self, state: _CopyState) -> str | Error:
+        """ Copy directory metadata and store the manifest of a rule once all of its files have been copied. 
+
+        Files that could not be copied are added to `copy_failures` and skipped by verification.
         
+        On success, return a path string of the copied directory, otherwise `Error` object. """
+
+        rule = state.rule
+        self.metrics.set("phase_seconds", state.finished - state.started, phase="copy", rule=rule.destination)
+        log(f"Indexed {choice(all_colors)}{len(state.index)}{Colors.RESET} files ({format_size(state.index.total_size)}) in {rule.source}", self.quiet)
+
+        if state.paths is not None: # Before restoring directory metadata, removals touch the parents' mtime
+            self._remove_deleted(state)
+        elif rule.prune and rule.format == FORMAT_MIRROR:
+            if state.walked and not state.errors:
+                self._prune(rule)
+            else: # Files missing from an incomplete pass over the source must not be mistaken for deleted ones
+                log(f"{Colors.BRIGHT_YELLOW}WARNING: Skipped pruning {rule.destination}, not every file of {rule.source} could be copied.{Colors.RESET}")
+
+        if rule.format == FORMAT_MIRROR and state.journal.interrupted: # Only crashed runs leave temporary files behind
+            self._sweep_temp_files(rule)
+
+        for src_dir, dst_dir in reversed(state.directories): # Children before parents, so copying files does not touch the parents' mtime afterwards
             try:
-                with scandir(current_path) as iterator:
-                    for entry in iterator:
-                        if ignore is not None and any(fnmatch(entry.name, pattern) for pattern in ignore):
-                            continue
-                        
-                        if entry.is_file():
-                            files.append(entry.path)
-                        elif entry.is_dir():
-                            other = _traverse_dir(entry.path)
-                            if isinstance(other, Error):
-                                return other
-                            
-                            files.extend(other)
-            except FileNotFoundError as exc:
-                return Error(f"{Colors.BRIGHT_RED}Path {current_path} does not exist!{Colors.RESET}", exc)
-            except NotADirectoryError as exc:
-                return Error(f"{Colors.BRIGHT_RED}Path {current_path} is not a directory!{Colors.RESET}", exc)
-            except PermissionError as exc:
-                return Error(f"{Colors.BRIGHT_RED}Unable to open directory {current_path} due to permission error.{Colors.RESET}", exc)
+                copystat(src_dir, dst_dir)
             except OSError as exc:
-                return Error(f"{Colors.BRIGHT_RED}An error occurred while recursing directory at {current_path}.\nErr: {exc}{Colors.RESET}", exc)
+                state.errors.append((src_dir, dst_dir, str(exc)))
 
-            return files
+            if self._syncer is not None:
+                self._syncer.add_directory(dst_dir)
+
+        if state.archive is not None:
+            archive = state.archive
+            ret = archive.close()
+            if isinstance(ret, Error):
+                self._archives.pop((rule.source, rule.destination), None)
+                return ret
 
-        ret = _traverse_dir(path)
+            if self._syncer is not None:
+                self._syncer.add(archive.path)
+                self._syncer.add(archive.index_path)
+
+            self.metrics.set("archive_bytes", archive.written, rule=rule.destination)
+            self.metrics.set("archive_compression_ratio", archive.size / archive.written if archive.written else 0, rule=rule.destination)
+            log(f"Archived {choice(all_colors)}{len(archive.members)}{Colors.RESET} files of {rule.source}, wrote {choice(all_colors)}{format_size(archive.written)}{Colors.RESET} ({format_size(archive.size)} uncompressed) to {archive.path}", self.quiet)
+
+        if self._syncer is not None: # Parents of the directories created for the rule
+            if state.store is not None:
+                extra = (state.store.objects_dir, state.store.snapshots_dir)
+            elif state.archive is not None:
+                extra = (dirname(state.archive.directory), state.archive.directory)
+            else:
+                extra = ()
+
+            for directory in (dirname(rule.destination), rule.destination, *extra):
+                self._syncer.add_directory(directory)
+
+        if state.manifest is not None:
+            # Keep what was copied so far even if the copy failed, so a rerun picks up from there.
+            # Entries are only pruned after a full pass over the source, otherwise unvisited files would be forgotten.
+            ret = state.manifest.save(prune=state.walked and not state.errors)
+            if isinstance(ret, Error):
+                return ret
+
+            if self._syncer is not None:
+                self._syncer.add(state.manifest.path)
+
+            changed = len(self._changed[(rule.source, rule.destination)])
+            log(f"Copied {choice(all_colors)}{changed}{Colors.RESET} changed files, skipped {choice(all_colors)}{len(state.manifest.entries) - changed}{Colors.RESET} unchanged files of {rule.source}", self.quiet)
+
+        if state.snapshot is not None:
+            ret = state.snapshot.save()
+            if isinstance(ret, Error):
+                return ret
+
+            if self._syncer is not None:
+                self._syncer.add(ret)
+
+            log(f"Stored {choice(all_colors)}{state.stored_files}{Colors.RESET} changed files of {rule.source}, wrote {choice(all_colors)}{format_size(state.stored_bytes)}{Colors.RESET} of new data to snapshot {ret}", self.quiet)
+
+        ret = state.journal.flush()
+        for error in (state.journal.error, ret):
+            if isinstance(error, Error):
+                log(error.msg)
+
+        self.metrics.add("copy_errors_total", len(state.errors), rule=rule.destination)
+        if state.copied_files:
+            self._record_history(rule, "copy", state.copied_files, state.copied_bytes, state.finished - state.started)
+
+        if state.errors:
+            self.copy_failures.extend(state.errors)
+            self._failed.setdefault((rule.source, rule.destination), set()).update(relpath(src, rule.source) for src, _, _ in state.errors)
+            log(f"{Colors.BRIGHT_RED}{len(state.errors)} file(s) of {rule.source} could not be copied.{Colors.RESET}")
+
+        return rule.destination
+
+    def _record_history(self, rule: Rule, phase: str, files: int, size: int, seconds: float) -> None:
+        """ Record the work done by a phase of a rule, so dry runs can estimate how long the next runs take. A history that cannot be written only loses estimates. """
+
+        history = History(rule.destination, rule.source)
+        ret = history.load()
         if isinstance(ret, Error):
-            return ret
-        
-        return ret if not sort else sorted(ret, key=basename)
+            log(ret.msg)
+            return
+
+        history.add(phase, files, size, seconds)
+        ret = history.save()
+        if isinstance(ret, Error):
+            log(ret.msg)
 
-    def _read_file_buffers(self, file_path: str, buf_size: int) -> Generator[bytes, None, None]:
-        """ Yield chunks of arbitrary size of file content for the given file path. """
+    def _latest_archive_members(self, rule: Rule) -> dict[str, list] | Error:
+        """ Return the members of the rule's latest complete archive, or an empty dict if there is none. Otherwise an `Error` object. """
 
-        with open(file_path, "rb") as f:
-            while True:
-                buf = f.read(buf_size)
-                if not buf:
-                    return
+        index_path = latest_index(rule.destination, rule.source)
+        if index_path is None or isinstance(index_path, Error):
+            return {} if index_path is None else index_path
+
+        reader = ArchiveReader.open(index_path)
+
+        return reader if isinstance(reader, Error) else reader.members
+
+    def _plan_rule(self, rule: Rule) -> TransferPlan | Error:
+        """ Scan a rule's source without reading any file and classify every file as new, changed or unchanged, the way a run would.
+
+        Files are compared with the rule's manifest, latest snapshot or latest archive index when it has one, otherwise with the destination's size and mtime.
+
+        Return the plan, otherwise an `Error` object if the rule's state could not be loaded. """
+
+        plan = TransferPlan(rule.source, rule.destination, rule.format == FORMAT_ARCHIVE or (rule.format == FORMAT_MIRROR and not rule.incremental))
+        previous: dict[str, list] | None = None # Relative path -> [size, mtime_ns, inode, ...]
+        manifest = None
+
+        if rule.format == FORMAT_STORE:
+            previous = Snapshot(ObjectStore(rule.destination), rule.source).load_latest()
+        elif rule.format == FORMAT_ARCHIVE:
+            previous = self._latest_archive_members(rule)
+        elif rule.incremental:
+            manifest = Manifest(rule.destination, rule.hash_algorithm)
+            ret = manifest.load()
+            if isinstance(ret, Error):
+                return ret
 
-                yield buf
+        if isinstance(previous, Error):
+            return previous
 
-    def _compare_file_hashes(self, src: str, dst: str) -> bool | Error:
-        """ Build and compare source and destination files' hashes. """
+        def _on_walk_error(path: str, exc: OSError) -> None:
+            plan.errors += 1
+
+        follow_symlinks = not self.no_follow_symlinks or rule.format == FORMAT_STORE
+        try:
+            for relative_dir, entry in walk(rule.source, rule.matcher, follow_symlinks, on_error=_on_walk_error):
+                try:
+                    if (entry.is_symlink() and not follow_symlinks) or entry.is_dir():
+                        continue
+
+                    relative = join(relative_dir, entry.name) if relative_dir else entry.name
+                    st = entry.stat()
+
+                    if previous is not None:
+                        entry_fields = previous.get(relative)
+                        status = NEW if entry_fields is None else UNCHANGED if entry_fields[:3] == [st.st_size, st.st_mtime_ns, st.st_ino] else CHANGED
+                    else:
+                        try:
+                            dst_st = stat(join(rule.destination, relative))
+                        except OSError:
+                            status = NEW
+                        else:
+                            if manifest is not None:
+                                status = UNCHANGED if manifest.is_unchanged(relative, st) else CHANGED
+                            else:
+                                status = UNCHANGED if (dst_st.st_size, dst_st.st_mtime_ns) == (st.st_size, st.st_mtime_ns) else CHANGED
+                except OSError:
+                    plan.errors += 1
+                    continue
+
+                plan.add(relative, st.st_size, status)
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}An error occurred while scanning {rule.source}.\nErr: {exc}{Colors.RESET}", exc)
+
+        return plan
+
+    def _do_plan(self) -> None:
+        """ Log the transfer plan of every rule, with its estimated duration from the rule's recorded runs. """
+
+        total_files = total_size = 0
+        copy_total: float | None = 0
+        verify_total: float | None = 0 if self.hash_verification else None
+
+        for rule in self.rules:
+            plan = self._plan_rule(rule)
+            if isinstance(plan, Error):
+                log(plan.msg)
+                copy_total = verify_total = None
+                continue
+
+            history = History(rule.destination, rule.source)
+            ret = history.load()
+            if isinstance(ret, Error):
+                log(ret.msg)
+
+            files, size = plan.files_to_copy, plan.bytes_to_copy
+            copy_seconds = history.estimate("copy", files, size) if files else 0
+            verify_seconds = (history.estimate("verify", files, size) if files else 0) if self.hash_verification else None
+            log(plan.summary(copy_seconds, verify_seconds, self.hash_verification))
+
+            self.metrics.set("planned_files", files, rule=rule.destination)
+            self.metrics.set("planned_bytes", size, rule=rule.destination)
+
+            total_files += files
+            total_size += size
+            copy_total = None if copy_seconds is None or copy_total is None else copy_total + copy_seconds
+            verify_total = None if verify_seconds is None or verify_total is None else verify_total + verify_seconds
+
+        summary = f"{choice(all_colors)}[DRY RUN] A run would copy {total_files} files ({format_size(total_size)})"
+        if copy_total is not None:
+            total_seconds = copy_total + (verify_total or 0)
+            if verify_total is not None:
+                summary += f" in about {format_duration(total_seconds)}, including verification"
+            elif self.hash_verification:
+                summary += f" in about {format_duration(total_seconds)} for the copy, verification time unknown"
+            else:
+                summary += f" in about {format_duration(total_seconds)}, hash verification disabled"
+            self.metrics.set("planned_seconds", total_seconds)
+
+        log(f"{summary}{Colors.RESET}")
+
+    def failure_report(self) -> str:
+        """ Return a string listing every file that could not be copied and why. """
+
+        report = f"{Colors.BRIGHT_RED}Error(s) occurred while copying files.{Colors.RESET}\n"
+        for src, dst, msg in self.copy_failures:
+            report += f"{Colors.BRIGHT_RED}Failed to copy {src} to {dst}. Err: {msg}{Colors.RESET}\n"
+
+        return report
+
+    def finish_run(self) -> None:
+        """ Discard the journals and source digests of this run once it went through every file, so the next run starts over instead of resuming it.
+        Files that failed to copy or verify were not journaled as copied, so starting over copies them again. """
+
+        self._source_digests.clear()
+
+        for journal in self._journals.values():
+            ret = journal.remove()
+            if isinstance(ret, Error):
+                log(ret.msg)
+
+        self._journals.clear()
+
+    def copy_files(self, paths: dict[Rule, set[str] | None] | None=None) -> tuple[list[str], list[str]] | Error:
+        """ Copy all files from source to destination as defined in the rules file. 
         
-        src_hash = sha256()
-        dst_hash = sha256()
+        Rules are walked one after another, but their files are copied concurrently by a shared `CopyScheduler`.
+        With paths, only the given rules are copied, each only for its given relative paths or entirely if they are `None`.
+
+        Return a tuple with two lists containing source and copied directories' paths respectively. """
+
+        source, copied = [], []
+        rules = self.rules if paths is None else list(paths)
+        self.copy_failures = []
+        self._failed = {}
+        self._source_digests.clear() # Left over by files a previous verification skipped or never reached
+
+        if self.dry_run:
+            self._do_plan()
+
+            for rule in rules:
+                if rule.prune and rule.format == FORMAT_MIRROR and isdir(rule.destination):
+                    self._prune(rule)
+                
+                copied.append(rule.destination)
+                source.append(rule.source)
+
+            return source, copied
+
+        states = []
+        compressor = ProcessPoolExecutor(max_workers=self.compress_workers) if any(rule.format == FORMAT_ARCHIVE for rule in rules) else None
+        scheduler = CopyScheduler(self.copy_workers, self.copy_workers_per_device)
+        if self.sync_mode == SYNC_FILES and self._syncer is None: # Kept until `sync` if files are copied several times
+            self._syncer = FileSyncer(DEFAULT_SYNC_WORKERS)
+        self._progress = Progress("Copying", self.quiet).start()
 
         try:
-            log(f"Verifying hash of {choice(all_colors)}{src}{Colors.RESET} with {choice(all_colors)}{dst}{Colors.RESET}", self.quiet)
+            for rule in rules:
+                ret = self._do_copy_op(rule, scheduler, compressor, paths[rule] if paths is not None else None)
+                if isinstance(ret, Error):
+                    return ret # Files already scheduled are still copied before returning
 
-            for src_buf in self._read_file_buffers(src, FILE_BUF_SIZE):
-                src_hash.update(src_buf)
-            for dst_buf in self._read_file_buffers(dst, FILE_BUF_SIZE):
-                dst_hash.update(dst_buf)
+                states.append(ret)
 
-            return src_hash.hexdigest() == dst_hash.hexdigest()
+            self._progress.set_total(sum(len(state.index) for state in states), sum(state.index.total_size for state in states))
+        finally:
+            scheduler.shutdown()
+            self._progress.stop()
+            
+            for state in states:
+                ret = self._finish_copy_op(state)
+                if isinstance(ret, Error):
+                    state.error = ret
+
+            if compressor is not None:
+                compressor.shutdown()
+
+        for state in states:
+            if state.error is not None:
+                return state.error
+            
+            copied.append(state.rule.destination)
+            source.append(state.rule.source)
+
+        return source, copied
+    
+    def sync(self) -> None | Error:
+        """ Make the data written by this run durable, according to the sync mode: 
+        only the files and directories written by the run, every destination filesystem, or every filesystem of the host.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        errors: list[tuple[str, OSError]] = []
+
+        if self.sync_mode == SYNC_FILES:
+            if self._syncer is None:
+                return None # Nothing was copied
+
+            syncer, self._syncer = self._syncer, None
+            errors = syncer.finish()
+            self.metrics.add("files_synced_total", syncer.synced_files)
+            self.metrics.add("directories_synced_total", syncer.synced_directories)
+        elif self.sync_mode == SYNC_FILESYSTEM and SUPPORTS_SYNCFS:
+            errors = sync_filesystems([rule.destination for rule in self.rules])
+        elif self.sync_mode in (SYNC_FILESYSTEM, SYNC_GLOBAL) and SUPPORTS_GLOBAL_SYNC:
+            if self.sync_mode == SYNC_FILESYSTEM:
+                log(f"{Colors.BRIGHT_YELLOW}WARNING: This OS cannot sync a single filesystem, syncing all of them instead.{Colors.RESET}")
+
+            try:
+                sync_all()
+            except OSError as exc:
+                errors.append(("/", exc))
+        elif self.sync_mode is not None:
+            log(f"Unable to sync filesystem. OS might not provide support for it, and hash verification might fail due to unwritten buffers.")
+
+        if errors:
+            error_msg = f"{Colors.BRIGHT_RED}Syncing filesystem failed. Cannot proceed with hash verification. Your copy may not be fully written.{Colors.RESET}\n"
+            for path, exc in errors:
+                error_msg += f"{Colors.BRIGHT_RED}Failed to sync {path}. Err: {exc}{Colors.RESET}\n"
+
+            return Error(error_msg, errors[0][1])
+
+        return None
+
+    def _recurse_directory(self, path: str, matcher: IgnoreMatcher | None=None, sort: bool=False) -> Generator[str | Error, None, None]:
+        """ Walk the given directory path and yield the paths of all inner files as they are found. Memory use does not grow with the number of files.
+        
+        Additionally, exclusions can be specified as a compiled matcher of glob patterns with the matcher argument. 
+        With sort, files are yielded in a stable depth-first order, sorted by name within each directory.
+
+        On failure, an Error object is yielded as the last item. """
+
+        try:
+            for _, entry in walk(path, matcher, sort=sort):
+                if entry.is_file():
+                    yield entry.path
         except FileNotFoundError as exc:
-            return Error(f"{Colors.BRIGHT_RED}Required files were not found during hash verification of file {src} with {dst}{Colors.RESET}", exc)
+            yield Error(f"{Colors.BRIGHT_RED}Path {exc.filename} does not exist!{Colors.RESET}", exc)
+        except NotADirectoryError as exc:
+            yield Error(f"{Colors.BRIGHT_RED}Path {exc.filename} is not a directory!{Colors.RESET}", exc)
         except PermissionError as exc:
-            return Error(f"{Colors.BRIGHT_RED}Unable to open required files for hash verification of file {src} with {dst}{Colors.RESET}", exc)
+            yield Error(f"{Colors.BRIGHT_RED}Unable to open directory {exc.filename} due to permission error.{Colors.RESET}", exc)
         except OSError as exc:
+            yield Error(f"{Colors.BRIGHT_RED}An error occurred while recursing directory at {exc.filename}.\nErr: {exc}{Colors.RESET}", exc)
+
+    def _log_verification_result(self, result: VerificationResult) -> None:
+        if result.matched:
+            debug("Verified hash of %s with %s", result.source, result.destination)
+        else:
+            self.verification_failures.append(result)
+
+    def _verification_error(self, result: VerificationResult) -> Error:
+        """ Build an `Error` object out of a pair that could not be hashed. """
+
+        src, dst, exc = result.source, result.destination, result.error
+
+        if isinstance(exc, FileNotFoundError):
+            return Error(f"{Colors.BRIGHT_RED}Required files were not found during hash verification of file {src} with {dst}{Colors.RESET}", exc)
+        elif isinstance(exc, PermissionError):
+            return Error(f"{Colors.BRIGHT_RED}Unable to open required files for hash verification of file {src} with {dst}{Colors.RESET}", exc)
+        elif isinstance(exc, OSError):
             return Error(f"{Colors.BRIGHT_RED}An error occurred while reading file buffers: {exc}{Colors.RESET}", exc)
+        
+        return Error(f"{Colors.BRIGHT_RED}An error occurred while verifying hash of file {src} with {dst}: {exc}{Colors.RESET}", exc)
+
+    def _store_pairs(self, rule: Rule) -> Generator[tuple[str, str, str], None, None] | Error:
+        """ Build the verification pairs of a store rule. Each object is checked against the digest it is named after, so the source is not read again.
+
+        Only objects read or written during this run are checked. If nothing was stored by this manager, every object of the latest snapshot is checked.
+
+        Return a generator of pairs, otherwise an `Error` object. """
+
+        store = ObjectStore(rule.destination)
+        digests = self._store_objects.get((rule.source, rule.destination))
+        journal = self._journals.get((rule.source, rule.destination))
+
+        if digests is None:
+            files = Snapshot(store, rule.source).load_latest()
+            if isinstance(files, Error):
+                return files
+
+            digests = {digest for entry in files.values() for digest in entry[5]}
+
+        return ((store.object_path(digest), store.object_path(digest), digest) for digest in digests if journal is None or not journal.is_verified(digest))
+
+    def _open_hash_cache(self) -> HashCache | None:
+        """ Open the persistent hash cache, if enabled. A cache that cannot be opened only disables caching. """
+
+        if self.hash_cache_path is None:
+            return None
+        elif not SUPPORTS_HASH_CACHE:
+            log(f"{Colors.BRIGHT_YELLOW}WARNING: This Python build has no sqlite3 module, continuing without hash cache.{Colors.RESET}")
+            return None
 
-    def _do_hash_verification(self) -> bool | Error:
-        """ Compute and compare SHA-256 hashes of all provided rules' source and destination files. """
+        cache = HashCache(self.hash_cache_path, HASH_CACHE_MAX_ENTRIES)
+        ret = cache.open()
+        if isinstance(ret, Error):
+            log(ret.msg)
+            return None
+
+        return cache
+
+    def _verification_total(self, rules: list[Rule]) -> int | None:
+        """ Return the number of pairs verification will check, or `None` if a rule's source has not been scanned by this manager. """
+
+        total = 0
+        for rule in rules:
+            if rule.format == FORMAT_ARCHIVE:
+                archive = self._archives.get((rule.source, rule.destination))
+                if archive is None:
+                    return None
+
+                total += len(archive.members)
+            elif rule.format == FORMAT_STORE:
+                digests = self._store_objects.get((rule.source, rule.destination))
+                if digests is None:
+                    return None
+
+                total += len(digests)
+            elif (rule.source, rule.destination) in self._changed:
+                total += len(self._changed[(rule.source, rule.destination)])
+            elif (rule.source, rule.destination) in self._indexes:
+                total += len(self._indexes[(rule.source, rule.destination)])
+            else:
+                return None
+
+        return total
+
+    def _do_hash_verification(self, rules: list[Rule]) -> bool | Error:
+        """ Compute and compare hashes of all provided rules' source and destination files, with each rule's hash algorithm. """
         
-        for rule in self.rules:
-            dst_files, src_files = self._recurse_directory(rule.destination, rule.ignore), self._recurse_directory(rule.source, rule.ignore)
-            if isinstance(src_files, Error):
-                return src_files
-            elif isinstance(dst_files, Error):
-                return dst_files
+        self.verification_failures = []
+        verifier = HashVerifier(self.verify_workers, self.verify_processes)
+        cache = self._open_hash_cache()
+        self._progress = Progress("Verifying", self.quiet)
+        self._progress.set_total(self._verification_total(rules))
+        self._progress.start()
 
-            src_files = set(src_files)
-            for dst_file in dst_files:
-                relative = relpath(dst_file, rule.destination)
-                src_file = join(rule.source, relative)
+        try:
+            return self._verify_rules(verifier, cache, rules)
+        finally:
+            self._progress.stop()
+            if cache is not None:
+                ret = cache.close()
+                if isinstance(ret, Error):
+                    log(ret.msg)
 
-                if src_file not in src_files:
-                    continue # we did not copy this file
+    def _verify_archive(self, rule: Rule) -> bool | Error:
+        """ Check every member of the rule's archive against the SHA-256 digest its index recorded while archiving, decompressing the archive once on a process pool.
 
-                ret = self._compare_file_hashes(src_file, dst_file)
+        The archive written during this run is checked, otherwise the latest complete one. """
+
+        archive = self._archives.get((rule.source, rule.destination))
+        index_path = archive.index_path if archive is not None else latest_index(rule.destination, rule.source)
+        if isinstance(index_path, Error):
+            return index_path
+        elif index_path is None:
+            return Error(f"{Colors.BRIGHT_RED}No complete archive of {rule.source} was found in {rule.destination}.{Colors.RESET}")
+
+        reader = ArchiveReader.open(index_path)
+        if isinstance(reader, Error):
+            return reader
+
+        hashed_bytes = verified = 0
+        executor = ProcessPoolExecutor(max_workers=self.compress_workers)
+
+        try:
+            with self.metrics.phase("verify", rule=rule.destination):
+                for relative, size, matched in reader.verify(executor, self.compress_workers * 2):
+                    result = VerificationResult(join(rule.source, relative), f"{reader.path}:{relative}")
+                    result.source_digest = reader.members[relative][4]
+                    result.destination_digest = result.source_digest if matched else None
+                    self._log_verification_result(result)
+
+                    hashed_bytes += size
+                    verified += 1
+                    self._progress.update(size)
+
+                    if not matched:
+                        log(f"{Colors.BRIGHT_RED}Hash verification failed for file {relative} in archive {reader.path}.{Colors.RESET}")
+                        return False
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to read archive {reader.path} for hash verification.\nErr: {exc}{Colors.RESET}", exc)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+            seconds = self.metrics.get("phase_seconds", phase="verify", rule=rule.destination)
+            self.metrics.add("files_verified_total", verified, rule=rule.destination)
+            self.metrics.add("bytes_hashed_total", hashed_bytes, rule=rule.destination)
+            self.metrics.set("hash_bytes_per_second", hashed_bytes / seconds if seconds else 0, rule=rule.destination)
+            if verified:
+                self._record_history(rule, "verify", verified, hashed_bytes, seconds)
+
+        return True
+
+    def _verify_rules(self, verifier: HashVerifier, cache: HashCache | None, rules: list[Rule]) -> bool | Error:
+        """ Verify every rule in turn. Source digests come from the copy, the hash cache or the verifier, in that order. """
+
+        for rule in rules:
+            if rule.format == FORMAT_ARCHIVE:
+                ret = self._verify_archive(rule)
+                if ret is not True:
+                    return ret
+
+                continue
+
+            index = self._indexes.get((rule.source, rule.destination))
+            manifest = self._manifests.get((rule.source, rule.destination))
+            changed = self._changed.get((rule.source, rule.destination))
+            failed = self._failed.get((rule.source, rule.destination), set())
+            journal = self._journals.get((rule.source, rule.destination))
+            store = ObjectStore(rule.destination) if rule.format == FORMAT_STORE else None
+            prefix_len = len(join(rule.source, ""))
+            scan_errors: list[Error] = []
+
+            def _relative_paths() -> Generator[tuple[str, int | None], None, None]:
+                if index is not None:
+                    for relative, size, _ in index:
+                        yield relative, size
+
+                    return
+
+                # Nothing was copied by this manager, so stream a fresh scan of the source. Hashing starts before the scan ends
+                for path in self._recurse_directory(rule.source, rule.matcher):
+                    if isinstance(path, Error):
+                        scan_errors.append(path)
+                        return
+
+                    yield path[prefix_len:], None
+
+            pending_stats: dict[str, stat_result] = {} # Stat results of sources the verifier has to hash, taken before hashing
+            pending_bytes: dict[str, tuple[int, int]] = {} # File size and bytes the verifier has to hash for each source
+            hashed_bytes = verified = verified_size = 0
+
+            def _pairs() -> Generator[tuple[str, str, str | None], None, None]:
+                for relative, size in _relative_paths():
+                    if changed is not None and relative not in changed:
+                        continue # unchanged since a previous, verified run
+                    elif relative in failed or (journal is not None and journal.is_verified(relative)):
+                        continue # not copied, or verified by an interrupted run
+
+                    src_file, dst_file = join(rule.source, relative), join(rule.destination, relative)
+                    src_digest = self._source_digests.pop(dst_file, None) # Only needed once, the dict would grow with every watch batch
+                    st = None
+
+                    if (src_digest is None and cache is not None) or size is None:
+                        try:
+                            st = stat(src_file)
+                        except OSError:
+                            pass # Reported by the verifier when it tries to read the file
+                        else:
+                            size = st.st_size
+
+                    if src_digest is None and cache is not None and st is not None:
+                        src_digest = cache.get(rule.hash_algorithm, st)
+                        if src_digest is None:
+                            pending_stats[src_file] = st
+                        else:
+                            self.metrics.add("hash_cache_hits_total", rule=rule.destination)
+
+                    pending_bytes[src_file] = (size or 0, (size or 0) * (1 if src_digest is not None else 2))
+                    yield src_file, dst_file, src_digest
+
+            def _on_result(result: VerificationResult) -> None:
+                nonlocal hashed_bytes, verified, verified_size
+                self._log_verification_result(result)
+
+                file_size, size = pending_bytes.pop(result.source, (None, None))
+                if size is None: # Store objects, whose digest is known
+                    try:
+                        file_size = size = getsize(result.destination)
+                    except OSError:
+                        file_size = size = 0
+
+                hashed_bytes += size
+                verified_size += file_size
+                verified += 1
+                self._progress.update(size)
+
+                if journal is not None:
+                    key = result.source_digest if rule.format == FORMAT_STORE else result.source[prefix_len:]
+                    if result.matched:
+                        journal.record_verified(key)
+                    else:
+                        journal.record_invalid(key)
+
+                st = pending_stats.pop(result.source, None)
+                if st is not None and result.source_digest is not None:
+                    cache.put(rule.hash_algorithm, st, result.source_digest)
+
+                if store is not None and not result.matched and result.error is None: # Otherwise the store would trust it forever
+                    ret = store.discard(result.source_digest)
+                    if isinstance(ret, Error):
+                        log(ret.msg)
+
+                if manifest is not None and result.matched:
+                    manifest.set_digest(result.source[prefix_len:], result.source_digest)
+                elif manifest is not None: # Otherwise the next run would skip the bad copy as unchanged
+                    manifest.discard(result.source[prefix_len:])
+
+            if rule.format == FORMAT_STORE:
+                pairs = self._store_pairs(rule)
+                if isinstance(pairs, Error):
+                    return pairs
+            else:
+                pairs = _pairs()
+
+            algorithm = HASH_SHA256 if rule.format == FORMAT_STORE else rule.hash_algorithm # Store objects are named after their SHA-256 hash
+            with self.metrics.phase("verify", rule=rule.destination):
+                mismatch = verifier.verify(pairs, _on_result, algorithm)
+
+            if journal is not None:
+                ret = journal.flush()
+                if isinstance(ret, Error):
+                    log(ret.msg)
+
+            seconds = self.metrics.get("phase_seconds", phase="verify", rule=rule.destination)
+            self.metrics.add("files_verified_total", verified, rule=rule.destination)
+            self.metrics.add("bytes_hashed_total", hashed_bytes, rule=rule.destination)
+            self.metrics.set("hash_bytes_per_second", hashed_bytes / seconds if seconds else 0, rule=rule.destination)
+            if verified:
+                self._record_history(rule, "verify", verified, verified_size, seconds)
+
+            if scan_errors:
+                return scan_errors[0]
+
+            if manifest is not None:
+                ret = manifest.save()
                 if isinstance(ret, Error):
                     return ret
-                elif not ret:
-                    log(f"{Colors.BRIGHT_RED}Hash verification failed for file {src_file} with {dst_file}.{Colors.RESET}")
-                    return False
+
+            if mismatch is not None:
+                if mismatch.error is not None:
+                    return self._verification_error(mismatch)
+
+                log(f"{Colors.BRIGHT_RED}Hash verification failed for file {mismatch.source} with {mismatch.destination}.{Colors.RESET}")
+                return False
 
         return True
 
-    def verify_hashes(self) -> bool | Error:
-        return self._do_hash_verification()
+    def verify_hashes(self, rules: list[Rule] | None=None) -> bool | Error:
+        """ Verify the given rules, all of them by default. Rules copied by this manager only verify what their copy scanned. """
+
+        return self._do_hash_verification(rules if rules is not None else self.rules)
@@ -0,0 +1,228 @@
+from backupmanager import BackupManager
+from rulesparser import Rule
+from walker import walk
+from error import Error
+from constants import SYNC_MODES, DEFAULT_SYNC_MODE, HASH_ALGORITHMS, DEFAULT_HASH_ALGORITHM, DEFAULT_COPY_WORKERS, DEFAULT_COPY_WORKERS_PER_DEVICE, DEFAULT_VERIFY_WORKERS
+
+from argparse import ArgumentParser, Namespace
+from typing import Any, Callable
+from json import dumps
+from random import Random
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import perf_counter
+from os import makedirs
+from os.path import join
+from sys import exit as sysexit, stderr
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+    _SUPPORTS_RUSAGE = True
+except ImportError:
+    _SUPPORTS_RUSAGE = False
+
+# Tree shapes: number of files, size of each file in bytes, directory nesting depth, subdirectories per level and ignore patterns per rule
+SHAPES = {
+    "tiny": {"files": 20000, "file_size": 512, "depth": 3, "fanout": 8, "ignore": 0},
+    "huge": {"files": 4, "file_size": 512 * 1024 ** 2, "depth": 1, "fanout": 1, "ignore": 0},
+    "deep": {"files": 2000, "file_size": 4096, "depth": 200, "fanout": 1, "ignore": 0},
+    "ignore": {"files": 20000, "file_size": 512, "depth": 3, "fanout": 8, "ignore": 500}
+}
+
+_BLOCK_SIZE = 1024 * 1024
+
+def _read_io_counters() -> dict[str, int]:
+    """ Return this process' I/O counters (Linux only). syscr and syscw count read and write syscalls, including all threads. """
+
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f)}
+    except OSError:
+        return {}
+
+def _peak_rss_kib() -> int | None:
+    """ Return the peak RSS of the process so far, not of the running phase: it only grows, so a phase's value includes every phase before it. """
+
+    return getrusage(RUSAGE_SELF).ru_maxrss if _SUPPORTS_RUSAGE else None # KiB on Linux
+
+def _metric_total(manager: BackupManager, name: str) -> float:
+    """ Return the sum of a metric over all of its labels. """
+
+    return sum(value for sample, _, value in manager.metrics.samples() if sample == name)
+
+def _ignore_pattern(i: int) -> tuple[str, str]:
+    """ Return the i-th ignore pattern and a format string for file names it matches.
+
+    Suffix globs, prefix globs and globs with a wildcard in the middle alternate, so both the matcher's suffix sets and its regular expression are exercised. """
+
+    kind = i % 3
+    if kind == 0:
+        return f"*.ignored{i}", f"f{{}}.ignored{i}"
+    elif kind == 1:
+        return f"cache{i}-*", f"cache{i}-f{{}}"
+    else:
+        return f"*.tmp{i}?.*", f"f{{}}.tmp{i}x.dat"
+
+def generate_tree(root: str, files: int, file_size: int, depth: int, fanout: int, ignore: int, seed: int) -> tuple[list[str], int]:
+    """ Build a reproducible synthetic tree under root.
+
+    Files are spread round-robin over fanout ** depth leaf directories (or a single chain of depth directories with a fanout of 1).
+    When ignore patterns are requested, one file in ten gets a name matched by one of them, in turn.
+
+    Return a tuple with the ignore patterns to use and the total number of bytes written. """
+
+    rng = Random(seed)
+    leaves = [""]
+    for _ in range(depth):
+        leaves = [join(leaf, f"d{i}") for leaf in leaves for i in range(fanout)]
+
+    for leaf in leaves:
+        makedirs(join(root, leaf), exist_ok=True)
+
+    patterns, names = zip(*(_ignore_pattern(i) for i in range(ignore))) if ignore else ((), ())
+    total = 0
+
+    for i in range(files):
+        name = names[(i // 10) % len(names)].format(i) if names and i % 10 == 0 else f"f{i}.dat"
+        path = join(root, leaves[i % len(leaves)], name)
+
+        with open(path, "wb") as f:
+            remaining = file_size
+            while remaining:
+                block = rng.randbytes(min(_BLOCK_SIZE, remaining))
+                f.write(block)
+                remaining -= len(block)
+
+        total += file_size
+
+    return list(patterns), total
+
+def _run_phase(name: str, fn: Callable[[], Any], processed: Callable[[Any], tuple[int, int]]) -> tuple[dict[str, Any], Any]:
+    """ Run one phase and measure its duration, throughput, syscalls and memory.
+
+    Throughput counts the files and bytes the phase actually processed, as returned by processed once it ran, not the size of the whole tree. """
+
+    before = _read_io_counters()
+    start = perf_counter()
+    ret = fn()
+    seconds = perf_counter() - start
+    after = _read_io_counters()
+    files, size = processed(ret)
+
+    metrics: dict[str, Any] = {
+        "phase": name,
+        "seconds": round(seconds, 6),
+        "files": files,
+        "files_per_s": round(files / seconds, 2) if seconds else None,
+        "mb_per_s": round(size / 1e6 / seconds, 2) if seconds and size else None,
+        "cumulative_peak_rss_kib": _peak_rss_kib()
+    }
+    for key, label in (("syscr", "read_syscalls"), ("syscw", "write_syscalls"), ("rchar", "bytes_read"), ("wchar", "bytes_written")):
+        if key in before and key in after:
+            metrics[label] = after[key] - before[key]
+
+    if isinstance(ret, Error):
+        metrics["error"] = ret.msg
+
+    return metrics, ret
+
+def run_benchmark(args: Namespace) -> dict[str, Any]:
+    """ Generate a tree for the requested shape, run the scan, copy, sync and verify phases over it and return the results. """
+
+    params = dict(SHAPES[args.shape])
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+
+    workdir = mkdtemp(prefix="backup-tool-bench-", dir=args.workdir)
+    source, destination = join(workdir, "source"), join(workdir, "destination")
+
+    try:
+        patterns, total = generate_tree(source, seed=args.seed, **params)
+        files = params["files"]
+
+        rule = Rule(source, destination, patterns, args.incremental, hash_algorithm=args.hash_algorithm)
+        manager = BackupManager(
+            False, False, True, [rule], args.verify_workers, args.verify_processes, args.hash_during_copy,
+            args.copy_workers, args.copy_workers_per_device, None, # Hash cache disabled, so runs are comparable
+            sync_mode=args.sync_mode
+        )
+
+        def _counted(files_metric: str, bytes_metric: str) -> Callable[[Any], tuple[int, int]]:
+            """ Return a function giving how much the metrics grew since it was made, called once the phase ran. """
+
+            files_before, bytes_before = _metric_total(manager, files_metric), _metric_total(manager, bytes_metric)
+            return lambda _: (int(_metric_total(manager, files_metric) - files_before), int(_metric_total(manager, bytes_metric) - bytes_before))
+
+        phases = []
+        scan_metrics, _ = _run_phase("scan", lambda: sum(1 for _, entry in walk(source, rule.matcher) if not entry.is_dir()), lambda scanned: (scanned, 0))
+        phases.append(scan_metrics)
+
+        for run in range(args.copy_runs):
+            copy_metrics, ret = _run_phase("copy" if run == 0 else f"copy_{run + 1}", manager.copy_files, _counted("files_copied_total", "bytes_read_total"))
+            phases.append(copy_metrics)
+            if isinstance(ret, Error):
+                break
+
+            manager.finish_run() # Otherwise the next copy run resumes this one
+
+        written = (int(_metric_total(manager, "files_copied_total")), int(_metric_total(manager, "bytes_written_total")))
+        phases.append(_run_phase("sync", manager.sync, lambda _: written)[0]) # Flushes what every copy run wrote
+
+        phases.append(_run_phase("verify", manager.verify_hashes, _counted("files_verified_total", "bytes_hashed_total"))[0])
+
+        return {
+            "shape": args.shape,
+            "params": {**params, "seed": args.seed, "hash_algorithm": args.hash_algorithm, "incremental": args.incremental},
+            "files": files,
+            "bytes": total,
+            "phases": phases,
+            "peak_rss_kib": _peak_rss_kib(),
+            "metrics": [{"name": name, "labels": labels, "value": value} for name, labels, value in manager.metrics.samples()]
+        }
+    finally:
+        if not args.keep:
+            rmtree(workdir, ignore_errors=True)
+
+def main(args: Namespace) -> None:
+    if args.shape not in SHAPES:
+        print(f"Unknown shape '{args.shape}', expected one of {', '.join(SHAPES)}", file=stderr)
+        sysexit(1)
+
+    output = dumps(run_benchmark(args), indent=None if args.compact else 4)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(
+        prog="backup-tool-bench",
+        description="Benchmarks backup-tool's copy, sync and verify phases on reproducible synthetic trees.",
+        allow_abbrev=False
+    )
+    argparser.add_argument("--shape", default="tiny", help=f"One of {', '.join(SHAPES)}.")
+    argparser.add_argument("--files", type=int, help="Overrides the shape's number of files.")
+    argparser.add_argument("--file-size", type=int, help="Overrides the shape's file size in bytes.")
+    argparser.add_argument("--depth", type=int, help="Overrides the shape's nesting depth.")
+    argparser.add_argument("--fanout", type=int, help="Overrides the shape's subdirectories per level.")
+    argparser.add_argument("--ignore", type=int, help="Overrides the shape's number of ignore patterns.")
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--copy-runs", type=int, default=1, help="Copy the tree this many times, useful with --incremental.")
+    argparser.add_argument("--incremental", action="store_true")
+    argparser.add_argument("--hash-algorithm", choices=HASH_ALGORITHMS, default=DEFAULT_HASH_ALGORITHM)
+    argparser.add_argument("--hash-during-copy", action="store_true")
+    argparser.add_argument("--sync-mode", choices=SYNC_MODES, default=DEFAULT_SYNC_MODE)
+    argparser.add_argument("--copy-workers", type=int, default=DEFAULT_COPY_WORKERS)
+    argparser.add_argument("--copy-workers-per-device", type=int, default=DEFAULT_COPY_WORKERS_PER_DEVICE)
+    argparser.add_argument("--verify-workers", type=int, default=DEFAULT_VERIFY_WORKERS)
+    argparser.add_argument("--verify-processes", action="store_true")
+    argparser.add_argument("--workdir", help="Directory to create the synthetic trees in. Defaults to the system's temporary directory.")
+    argparser.add_argument("--keep", action="store_true", help="Keeps the synthetic trees after the run.")
+    argparser.add_argument("--output", help="Writes the JSON results to this file instead of the standard output.")
+    argparser.add_argument("--compact", action="store_true", help="Writes the JSON results on a single line.")
+    args = argparser.parse_args()
+
+    main(args)
@@ -1,5 +1,90 @@
+from os import cpu_count
 from os.path import join, dirname
 
 PATH = dirname(__file__)
 RULES_JSON_PATH = join(PATH, "rules.json")
-FILE_BUF_SIZE = 8192
\ No newline at end of file
+HASH_CACHE_PATH = join(PATH, "hashcache.sqlite3")
+HASH_CACHE_MAX_ENTRIES = 5_000_000 # Roughly 1 GB on disk
+FILE_BUF_SIZE = 8192 # Smallest read buffer, buffers grow with the file size and the device's block size
+HASH_BUF_MAX_SIZE = 1024 * 1024
+
+HASH_SHA256 = "sha256"
+HASH_BLAKE2B = "blake2b" # Faster than SHA-256 on CPUs without SHA extensions
+HASH_SAMPLED = "sampled" # Quick check: hashes the size and a few ranges of each file instead of the whole content
+HASH_ALGORITHMS = (HASH_SHA256, HASH_BLAKE2B, HASH_SAMPLED)
+DEFAULT_HASH_ALGORITHM = HASH_SHA256
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 64 * 1024
+DEFAULT_VERIFY_WORKERS = min(32, (cpu_count() or 1) + 4) # Same default as ThreadPoolExecutor, hashing is mostly I/O bound
+COPY_BUF_SIZE = 1024 * 1024 # Used when the kernel cannot copy the data by itself
+LARGE_FILE_THRESHOLD = 1024 ** 3 # Files at least this large are copied in resumable chunks
+COPY_CHUNK_SIZE = 64 * 1024 ** 2
+DEFAULT_COPY_WORKERS = 16
+DEFAULT_COPY_WORKERS_PER_DEVICE = 4 # Concurrent copies per (source, destination) device pair. Use 1 for spinning disks
+
+METADATA_DIR_NAME = ".backup-tool" # Created inside every destination that needs to keep state between runs
+MANIFEST_FILE_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+FORMAT_MIRROR = "mirror" # Plain copy of the source tree
+FORMAT_STORE = "store" # Content-addressed, deduplicating object store with per-run snapshots
+FORMAT_ARCHIVE = "archive" # Compressed tar archive per run, with an index of its members
+FORMATS = (FORMAT_MIRROR, FORMAT_STORE, FORMAT_ARCHIVE)
+
+STORE_OBJECTS_DIR_NAME = "objects"
+STORE_SNAPSHOTS_DIR_NAME = "snapshots"
+STORE_CHUNK_SIZE = 4 * 1024 ** 2
+SNAPSHOT_VERSION = 1
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_XZ = "xz" # Smaller archives, much slower to write
+COMPRESSIONS = (COMPRESSION_GZIP, COMPRESSION_XZ)
+DEFAULT_COMPRESSION = COMPRESSION_GZIP
+GZIP_LEVEL = 6
+XZ_PRESET = 6
+ARCHIVES_DIR_NAME = "archives"
+ARCHIVE_CHUNK_SIZE = 4 * 1024 ** 2 # Tar stream bytes compressed independently, and the unit of random access into an archive
+ARCHIVE_INDEX_SUFFIX = ".index.json"
+ARCHIVE_INDEX_VERSION = 1
+DEFAULT_COMPRESS_WORKERS = cpu_count() or 1
+
+METRICS_FORMAT_JSONL = "jsonl" # One JSON object per sample, appended after every run
+METRICS_FORMAT_PROMETHEUS = "prometheus" # Textfile for the node exporter's textfile collector, replaced after every run
+METRICS_FORMATS = (METRICS_FORMAT_JSONL, METRICS_FORMAT_PROMETHEUS)
+METRICS_PREFIX = "backup_tool"
+SIZE_BUCKETS = ((4 * 1024, "<4KiB"), (1024 ** 2, "4KiB-1MiB"), (64 * 1024 ** 2, "1MiB-64MiB"), (1024 ** 3, "64MiB-1GiB"), (float("inf"), ">=1GiB")) # (exclusive upper bound, label)
+
+LOG_FLUSH_INTERVAL = 0.5 # Seconds between batched writes of log lines during long phases
+LOG_MAX_BUFFERED_LINES = 1024
+PROGRESS_INTERVAL = 5 # Seconds between progress summaries
+
+JOURNAL_FLUSH_ENTRIES = 256 # Entries appended to a rule's journal at once, at most this many completed files are copied again after a crash
+COPY_RETRIES = 3 # Attempts after the first one for files failing with a transient error
+COPY_RETRY_DELAY = 0.5 # Seconds before the first retry, doubled before each next one
+TEMP_SUFFIX = ".backup-tool-tmp" # Files are written as ".<name><suffix>" next to their destination, then renamed in place
+PARTIAL_SUFFIX = ".part" # Large files are written as ".<name>.<size>-<mtime><suffix>" so an interrupted copy can be resumed
+
+SYNC_FILES = "files" # fdatasync() every file written by the run, then fsync() their directories
+SYNC_FILESYSTEM = "filesystem" # syncfs() once per destination filesystem (Linux only)
+SYNC_GLOBAL = "global" # sync() every filesystem of the host
+SYNC_MODES = (SYNC_FILES, SYNC_FILESYSTEM, SYNC_GLOBAL)
+DEFAULT_SYNC_MODE = SYNC_FILES
+DEFAULT_SYNC_WORKERS = 8
+SYNC_BATCH_SIZE = 64
+
+DELTA_BLOCK_SIZE = 1024 * 1024 # Unit of change of delta transfers
+DELTA_DIGEST_SIZE = 16 # Bytes of BLAKE2b digest stored per block
+DELTA_MIN_SIZE = 64 * 1024 ** 2 # Smaller files are always copied whole
+BLOCK_MAPS_DIR_NAME = "blocks" # Inside `METADATA_DIR_NAME`
+BLOCK_MAP_VERSION = 1
+
+PRUNE_BATCH_SIZE = 256 # Stale entries removed at once while walking the destination
+PRUNE_WORKERS = 8
+
+HISTORY_VERSION = 1
+HISTORY_RUNS = 10 # Runs per phase kept to estimate durations from
+PLAN_LARGEST_ITEMS = 10 # Largest files and folders listed by dry run plans
+
+WATCH_DEBOUNCE = 2.0 # Seconds without events before the paths touched under the sources are copied
+WATCH_MAX_DELAY = 30.0 # Seconds after the first event of a batch it is copied at the latest, even if events keep coming
+WATCH_READ_SIZE = 64 * 1024 # Bytes of inotify events read at once
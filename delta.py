@@ -0,0 +1,107 @@
+from constants import METADATA_DIR_NAME, BLOCK_MAPS_DIR_NAME, BLOCK_MAP_VERSION, DELTA_BLOCK_SIZE, DELTA_DIGEST_SIZE
+from hashing import new_hash
+
+from hashlib import sha256, blake2b
+from json import loads, dumps
+from os import fsencode, stat_result, stat, fstat, ftruncate, makedirs, replace, unlink, preadv, pwrite
+from os.path import join, dirname
+from shutil import copystat
+
+def block_map_path(destination: str, relative: str) -> str:
+    """ Return the path of the block map of a destination file, named after a hash of its path relative to the rule's destination. """
+
+    name = sha256(fsencode(relative)).hexdigest()
+    return join(destination, METADATA_DIR_NAME, BLOCK_MAPS_DIR_NAME, name[:2], name[2:])
+
+def _load_digests(path: str, st: stat_result) -> bytes | None:
+    """ Return the block digests stored at path if they describe the destination file with the given stat result, otherwise `None`.
+
+    A block map is only a cache of the destination's content, so a missing, stale or unreadable one is simply ignored. """
+
+    try:
+        with open(path, "rb") as f:
+            header, _, digests = f.read().partition(b"\n")
+
+        header = loads(header)
+        if (
+            header.get("version") != BLOCK_MAP_VERSION or header.get("block_size") != DELTA_BLOCK_SIZE
+            or [header.get("size"), header.get("mtime_ns"), header.get("inode")] != [st.st_size, st.st_mtime_ns, st.st_ino]
+            or len(digests) != -(-st.st_size // DELTA_BLOCK_SIZE) * DELTA_DIGEST_SIZE
+        ):
+            return None
+    except (OSError, ValueError, AttributeError):
+        return None
+
+    return digests
+
+def _save_digests(path: str, st: stat_result, digests: bytearray) -> None:
+    header = {"version": BLOCK_MAP_VERSION, "block_size": DELTA_BLOCK_SIZE, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+    makedirs(dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(dumps(header).encode() + b"\n")
+        f.write(digests)
+
+    replace(f"{path}.tmp", path)
+
+def delta_copy(src: str, dst: str, map_path: str, algorithm: str | None=None) -> tuple[int, str | None]:
+    """ Update the existing file at dst to match src by rewriting, in place, only the `DELTA_BLOCK_SIZE` blocks that differ, then copy metadata like `shutil.copy2`.
+
+    Blocks are compared against the digests stored in the block map at map_path when it still describes dst, so dst is not read at all.
+    Otherwise both files are read and compared. The source is always read once, and hashed with algorithm if given.
+    The block map is removed before writing and saved again once dst is complete, so an interrupted update is compared by reading dst next time.
+
+    Return a tuple with the number of bytes written and the source's hex digest, or `None` without algorithm. """
+
+    file_hash = new_hash(algorithm) if algorithm is not None else None
+    digests = bytearray()
+    written = offset = 0
+
+    with open(src, "rb", buffering=0) as src_f, open(dst, "r+b", buffering=0) as dst_f:
+        dst_fd = dst_f.fileno()
+        dst_size = fstat(dst_fd).st_size
+        known = _load_digests(map_path, fstat(dst_fd))
+
+        try:
+            unlink(map_path)
+        except FileNotFoundError:
+            pass
+
+        src_view = memoryview(bytearray(DELTA_BLOCK_SIZE))
+        dst_view = memoryview(bytearray(DELTA_BLOCK_SIZE)) if known is None else None
+
+        while True:
+            read = src_f.readinto(src_view)
+            if not read:
+                break
+
+            block = src_view[:read]
+            if file_hash is not None:
+                file_hash.update(block)
+
+            digest = blake2b(block, digest_size=DELTA_DIGEST_SIZE).digest()
+            position = len(digests)
+            digests += digest
+
+            if offset + read > dst_size:
+                same = False
+            elif known is not None:
+                same = known[position:position + DELTA_DIGEST_SIZE] == digest
+            else:
+                same = preadv(dst_fd, [dst_view[:read]], offset) == read and dst_view[:read] == block
+
+            if not same:
+                while block:
+                    block = block[pwrite(dst_fd, block, offset + read - len(block)):]
+
+                written += read
+
+            offset += read
+
+        if offset != dst_size:
+            ftruncate(dst_fd, offset)
+
+    copystat(src, dst)
+    _save_digests(map_path, stat(dst), digests)
+
+    return written, file_hash.hexdigest() if file_hash is not None else None
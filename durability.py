@@ -0,0 +1,141 @@
+from constants import SYNC_BATCH_SIZE
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from os import open as os_open, close as os_close, stat, fsync, strerror, O_RDONLY
+from os.path import dirname
+from threading import Lock
+
+try:
+    from os import fdatasync as _datasync # Skips metadata that is not needed to read the data back, like timestamps
+except ImportError: # macOS
+    _datasync = fsync
+
+try:
+    from os import sync
+    SUPPORTS_GLOBAL_SYNC = True
+except ImportError:
+    SUPPORTS_GLOBAL_SYNC = False
+
+try:
+    from ctypes import CDLL, c_int, get_errno
+    _syncfs = CDLL(None, use_errno=True).syncfs # Linux only, not exposed by the os module
+    _syncfs.argtypes = (c_int,)
+    SUPPORTS_SYNCFS = True
+except (ImportError, OSError, AttributeError):
+    SUPPORTS_SYNCFS = False
+
+def datasync(fd: int) -> None:
+    """ Flush the data of an open file, and the metadata needed to read it back, to stable storage. """
+
+    _datasync(fd)
+
+def sync_directory(path: str) -> None:
+    """ Make the entries of a directory durable, like files created in it. """
+
+    _sync_path(path, False)
+
+def _sync_path(path: str, data_only: bool) -> None:
+    fd = os_open(path, O_RDONLY)
+    try:
+        if data_only:
+            _datasync(fd)
+        else:
+            fsync(fd)
+    finally:
+        os_close(fd)
+
+class FileSyncer:
+    """ Flush the files written by a run to stable storage while the run keeps writing, instead of flushing the whole host with `sync()`.
+
+    Written files are queued and synced in batches of `SYNC_BATCH_SIZE` on a small thread pool, so the cost stays proportional to the run's own writes
+    and most of it is paid while other files are still being copied. The directories holding them are synced last, once, which makes their new entries durable. """
+
+    def __init__(self, workers: int) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="sync")
+        self._lock = Lock()
+        self._batch: list[str] = []
+        self._futures: list[Future] = []
+        self._directories: set[str] = set()
+
+        self.synced_files = 0
+        self.synced_directories = 0
+        self.errors: list[tuple[str, OSError]] = []
+
+    def _sync_batch(self, paths: list[str], data_only: bool) -> None:
+        for path in paths:
+            try:
+                _sync_path(path, data_only)
+            except OSError as exc:
+                with self._lock:
+                    self.errors.append((path, exc))
+
+    def add(self, path: str) -> None:
+        """ Queue a file that was written in place. Its directory is synced when the syncer finishes. """
+
+        with self._lock:
+            self._batch.append(path)
+            self._directories.add(dirname(path))
+            self.synced_files += 1
+
+            if len(self._batch) >= SYNC_BATCH_SIZE:
+                self._futures.append(self._executor.submit(self._sync_batch, self._batch, True))
+                self._batch = []
+
+    def add_directory(self, path: str) -> None:
+        """ Queue a directory whose entries or metadata changed, like a newly created one. """
+
+        with self._lock:
+            self._directories.add(path)
+
+    def finish(self) -> list[tuple[str, OSError]]:
+        """ Wait until every queued file and directory is synced.
+
+        Return a list of (path, exception) tuples for the paths that could not be synced. """
+
+        with self._lock:
+            if self._batch:
+                self._futures.append(self._executor.submit(self._sync_batch, self._batch, True))
+                self._batch = []
+
+            futures, self._futures = self._futures, []
+
+        wait(futures) # Files first, a directory entry must not become durable before the data it points to
+
+        directories = sorted(self._directories)
+        self.synced_directories = len(directories)
+        wait([self._executor.submit(self._sync_batch, directories[i:i + SYNC_BATCH_SIZE], False) for i in range(0, len(directories), SYNC_BATCH_SIZE)])
+
+        self._executor.shutdown()
+        return self.errors
+
+def sync_all() -> None:
+    """ Flush every filesystem of the host. Callers must check `SUPPORTS_GLOBAL_SYNC`. """
+
+    sync()
+
+def sync_filesystems(paths: list[str]) -> list[tuple[str, OSError]]:
+    """ Flush the filesystems holding the given paths with `syncfs()`, once per filesystem. Callers must check `SUPPORTS_SYNCFS`.
+
+    Return a list of (path, exception) tuples for the filesystems that could not be synced. """
+
+    errors = []
+    devices = set()
+
+    for path in paths:
+        try:
+            device = stat(path).st_dev
+            if device in devices:
+                continue
+
+            devices.add(device)
+            fd = os_open(path, O_RDONLY)
+            try:
+                if _syncfs(fd) != 0:
+                    errno = get_errno()
+                    raise OSError(errno, strerror(errno), path)
+            finally:
+                os_close(fd)
+        except OSError as exc:
+            errors.append((path, exc))
+
+    return errors
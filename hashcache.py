@@ -0,0 +1,114 @@
+from error import Error
+from colors import Colors
+
+from os import stat_result
+from time import time
+
+try:
+    from sqlite3 import connect, Connection, Error as sqliteError
+    SUPPORTS_HASH_CACHE = True
+except ImportError: # Python builds without the sqlite3 module
+    SUPPORTS_HASH_CACHE = False
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    algorithm TEXT NOT NULL,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (algorithm, device, inode, size, mtime_ns, ctime_ns)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used);
+"""
+
+class HashCache:
+    """ Persistent cache of file digests, keyed on file identity and modification times.
+
+    Any write to a file changes its mtime or ctime, so a cached digest is only returned for a file whose content has not changed since it was hashed.
+    The least recently used entries are evicted once the cache holds more than max_entries digests. """
+
+    def __init__(self, path: str, max_entries: int) -> None:
+        self.path = path
+        self.max_entries = max_entries
+
+        self._connection: Connection | None = None
+        self._hits: list[tuple] = [] # Keys to refresh the last use time of, written in a single batch on close
+        self._new: list[tuple] = []
+
+    def open(self) -> None | Error:
+        """ Open or create the cache database.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        try:
+            self._connection = connect(self.path)
+            self._connection.executescript(_SCHEMA)
+        except sqliteError as exc:
+            self._connection = None
+            return Error(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to open hash cache '{self.path}', continuing without it.\nErr: {exc}{Colors.RESET}", exc)
+
+        return None
+
+    @staticmethod
+    def _key(algorithm: str, st: stat_result) -> tuple:
+        return (algorithm, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    def get(self, algorithm: str, st: stat_result) -> str | None:
+        """ Return the cached digest of the file described by the stat result, or `None` on a miss. """
+
+        if self._connection is None:
+            return None
+
+        key = self._key(algorithm, st)
+        row = self._connection.execute(
+            "SELECT digest FROM hashes WHERE algorithm=? AND device=? AND inode=? AND size=? AND mtime_ns=? AND ctime_ns=?", key
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        self._hits.append(key)
+        return row[0]
+
+    def put(self, algorithm: str, st: stat_result, digest: str) -> None:
+        """ Remember the digest of the file described by the stat result, taken before it was hashed. """
+
+        if self._connection is not None:
+            self._new.append((*self._key(algorithm, st), digest))
+
+    def close(self) -> None | Error:
+        """ Write pending entries, evict the least recently used ones above the size limit and close the database.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        if self._connection is None:
+            return None
+
+        now = time()
+
+        try:
+            with self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(*entry, now) for entry in self._new])
+                self._connection.executemany(
+                    "UPDATE hashes SET last_used=? WHERE algorithm=? AND device=? AND inode=? AND size=? AND mtime_ns=? AND ctime_ns=?", [(now, *key) for key in self._hits]
+                )
+
+                count = self._connection.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+                if count > self.max_entries:
+                    self._connection.execute(
+                        "DELETE FROM hashes WHERE (algorithm, device, inode, size, mtime_ns, ctime_ns) IN "
+                        "(SELECT algorithm, device, inode, size, mtime_ns, ctime_ns FROM hashes ORDER BY last_used LIMIT ?)", (count - self.max_entries,)
+                    )
+        except sqliteError as exc:
+            return Error(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to update hash cache '{self.path}'.\nErr: {exc}{Colors.RESET}", exc)
+        finally:
+            self._connection.close()
+            self._connection = None
+            self._hits.clear()
+            self._new.clear()
+
+        return None
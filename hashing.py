@@ -0,0 +1,118 @@
+from constants import FILE_BUF_SIZE, HASH_BUF_MAX_SIZE, HASH_SHA256, HASH_SAMPLED, SAMPLE_COUNT, SAMPLE_SIZE
+
+from typing import Any, BinaryIO
+from hashlib import sha256, blake2b
+from shutil import copystat, SpecialFileError
+from os import stat, fstat
+from stat import S_ISFIFO, S_ISCHR, S_ISBLK, S_ISSOCK
+from threading import local
+
+_buffers = local() # One reusable read buffer per thread (or process)
+
+def new_hash(algorithm: str) -> Any:
+    """ Return a new hash object for the given algorithm. The sampled mode uses BLAKE2b over the sampled ranges. """
+
+    return sha256() if algorithm == HASH_SHA256 else blake2b()
+
+def ensure_regular(path: str, mode: int) -> None:
+    """ Raise `shutil.SpecialFileError` if mode is a named pipe, a device or a socket, like `shutil.copyfile` does for named pipes.
+    
+    Opening a named pipe blocks until a writer shows up and devices may never reach their end, so such files are never read. """
+
+    for check, kind in ((S_ISFIFO, "named pipe"), (S_ISCHR, "character device"), (S_ISBLK, "block device"), (S_ISSOCK, "socket")):
+        if check(mode):
+            raise SpecialFileError(f"`{path}` is a {kind}")
+
+def buffer_size(file_size: int, block_size: int) -> int:
+    """ Return the read buffer size for a file: the whole file rounded up to the device's preferred block size, capped at `HASH_BUF_MAX_SIZE`. """
+
+    block_size = max(block_size, FILE_BUF_SIZE)
+    wanted = -(-max(file_size, 1) // block_size) * block_size
+
+    return min(wanted, max(HASH_BUF_MAX_SIZE, block_size))
+
+def _get_buffer(size: int) -> memoryview:
+    """ Return a view of exactly size bytes over this thread's reusable buffer, growing it if needed. """
+
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = _buffers.buf = memoryview(bytearray(size))
+
+    return buf[:size]
+
+def _hash_sampled(f: BinaryIO, file_size: int) -> str:
+    """ Hash the file size and `SAMPLE_COUNT` evenly spaced ranges of `SAMPLE_SIZE` bytes, including the first and last ones.
+
+    Files too small to be sampled are hashed entirely. Catches truncation and most partial writes for a fraction of the I/O, but not every corruption. """
+
+    file_hash = blake2b(file_size.to_bytes(8, "little"))
+    view = _get_buffer(SAMPLE_SIZE)
+
+    if file_size <= SAMPLE_COUNT * SAMPLE_SIZE:
+        offsets = range(0, file_size, SAMPLE_SIZE)
+    else:
+        step = (file_size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+        offsets = range(0, step * SAMPLE_COUNT, step)
+
+    for offset in offsets:
+        f.seek(offset)
+        read = f.readinto(view)
+        file_hash.update(view[:read])
+
+    return file_hash.hexdigest()
+
+def hash_file(file_path: str, algorithm: str=HASH_SHA256) -> str:
+    """ Return the hex digest of the file at the given path with the given algorithm.
+
+    Reads go straight into a reused buffer sized after the file and the device's preferred block size, so no `bytes` object is created per chunk.
+    Kept at module level so it can be sent to worker processes. """
+
+    with open(file_path, "rb", buffering=0) as f:
+        st = fstat(f.fileno())
+
+        if algorithm == HASH_SAMPLED:
+            return _hash_sampled(f, st.st_size)
+
+        file_hash = new_hash(algorithm)
+        view = _get_buffer(buffer_size(st.st_size, getattr(st, "st_blksize", FILE_BUF_SIZE)))
+
+        while True:
+            read = f.readinto(view)
+            if not read:
+                break
+
+            file_hash.update(view[:read])
+
+    return file_hash.hexdigest()
+
+def copy_and_hash(src: str, dst: str, algorithm: str=HASH_SHA256) -> str:
+    """ Copy file contents and metadata from src to dst like `shutil.copy2`, hashing the bytes as they are written.
+
+    The sampled mode cannot be computed while streaming, use `hash_file` for it.
+
+    Raise `shutil.SpecialFileError` without opening src if it is not a regular file.
+
+    Return the hex digest of the source file. """
+
+    ensure_regular(src, stat(src).st_mode)
+    file_hash = new_hash(algorithm)
+
+    with open(src, "rb", buffering=0) as src_f, open(dst, "wb", buffering=0) as dst_f:
+        st = fstat(src_f.fileno())
+        view = _get_buffer(buffer_size(st.st_size, getattr(st, "st_blksize", FILE_BUF_SIZE)))
+
+        while True:
+            read = src_f.readinto(view)
+            if not read:
+                break
+
+            chunk = view[:read]
+            file_hash.update(chunk)
+
+            while chunk:
+                written = dst_f.write(chunk)
+                chunk = chunk[written:]
+
+    copystat(src, dst)
+
+    return file_hash.hexdigest()
@@ -0,0 +1,77 @@
+from constants import METADATA_DIR_NAME, HISTORY_VERSION, HISTORY_RUNS
+from error import Error
+from colors import Colors
+
+from hashlib import sha256
+from json import load, dump, JSONDecodeError
+from os import makedirs, replace
+from os.path import join, dirname
+from time import time
+
+class History:
+    """ Files, bytes and seconds of the last `HISTORY_RUNS` copies and verifications of a rule, stored at the rule's destination.
+
+    Used to estimate how long a planned run will take on the same source and destination. """
+
+    def __init__(self, destination: str, source: str) -> None:
+        self.path = join(destination, METADATA_DIR_NAME, f"history-{sha256(source.encode()).hexdigest()[:16]}.json")
+        self.runs: list[list] = [] # [timestamp, phase, files, bytes, seconds]
+
+    def load(self) -> None | Error:
+        """ Load the recorded runs. A missing history is treated as an empty one.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        try:
+            with open(self.path) as f:
+                content = load(f)
+        except FileNotFoundError:
+            return None
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to open history '{self.path}'.\nErr: {exc}{Colors.RESET}", exc)
+        except JSONDecodeError as exc:
+            return Error(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to parse history '{self.path}'.\nErr: {exc}{Colors.RESET}", exc)
+
+        if isinstance(content, dict) and content.get("version") == HISTORY_VERSION and isinstance(content.get("runs"), list):
+            self.runs = [run for run in content["runs"] if isinstance(run, list) and len(run) == 5]
+
+        return None
+
+    def add(self, phase: str, files: int, size: int, seconds: float) -> None:
+        self.runs.append([time(), phase, files, size, seconds])
+
+        runs = [run for run in self.runs if run[1] == phase]
+        if len(runs) > HISTORY_RUNS:
+            self.runs.remove(runs[0])
+
+    def save(self) -> None | Error:
+        """ Atomically write the recorded runs.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        try:
+            makedirs(dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.tmp", "w") as f:
+                dump({"version": HISTORY_VERSION, "runs": self.runs}, f, separators=(",", ":"))
+
+            replace(f"{self.path}.tmp", self.path)
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to write history '{self.path}'.\nErr: {exc}{Colors.RESET}", exc)
+
+        return None
+
+    def estimate(self, phase: str, files: int, size: int) -> float | None:
+        """ Return the seconds a phase would take for the given number of files and bytes, or `None` without recorded runs of the phase.
+
+        The recorded time is scaled by whichever of the file count or the byte count grows the most: runs of many small files are bound by
+        per-file costs, runs of a few large files by throughput. """
+
+        runs = [run for run in self.runs if run[1] == phase]
+        total_files = sum(run[2] for run in runs)
+        total_size = sum(run[3] for run in runs)
+        total_seconds = sum(run[4] for run in runs)
+
+        if not total_seconds or not (total_files or total_size):
+            return None
+
+        return total_seconds * max(files / total_files if total_files else 0, size / total_size if total_size else 0)
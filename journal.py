@@ -0,0 +1,156 @@
+from constants import METADATA_DIR_NAME, JOURNAL_FLUSH_ENTRIES
+from error import Error
+from colors import Colors
+from durability import datasync, sync_directory
+
+from typing import Any
+from hashlib import sha256
+from json import loads, dumps, JSONDecodeError
+from os import stat_result, makedirs, unlink
+from os.path import join, dirname, exists
+from threading import Lock
+
+_COPIED = "c"
+_VERIFIED = "v"
+_INVALIDATED = "x"
+
+class Journal:
+    """ Write-ahead journal of the files a rule copied and verified during a run that did not complete yet.
+
+    Every line is a JSON array appended once a file is fully written in place or verified, so an interrupted run can be resumed:
+    files whose source did not change since they were journaled are not copied again, and files verified since their last copy are not verified again.
+    Files failing verification are invalidated, so they are copied again.
+    Lines are appended in batches that are synced to stable storage, a crash loses at most the last `JOURNAL_FLUSH_ENTRIES` entries and a torn last line is ignored.
+    The journal is removed once the run went through every file, failed files are not journaled as copied so the next run copies them again. """
+
+    def __init__(self, destination: str, source: str) -> None:
+        self.path = join(destination, METADATA_DIR_NAME, f"journal-{sha256(source.encode()).hexdigest()[:16]}.jsonl")
+        self.copied: dict[str, list] = {} # Relative path -> [size, mtime_ns, inode, payload]
+        self.verified: set[str] = set() # Keys verified since they were last copied
+        self.interrupted = False # Whether a journal was left by a run that did not complete
+
+        self.error: Error | None = None # First failure to append entries while copying or verifying
+
+        self._lock = Lock()
+        self._lines: list[str] = []
+
+    def load(self) -> None | Error:
+        """ Load the entries of an interrupted run. A missing journal means the previous run completed.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return None
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to open journal '{self.path}' due to error:\n{exc}{Colors.RESET}", exc)
+
+        self.interrupted = True
+        for line in lines:
+            try:
+                kind, key, *fields = loads(line)
+            except (JSONDecodeError, TypeError, ValueError):
+                continue # Torn write of a crashed run
+
+            if kind == _COPIED and len(fields) == 4:
+                self.copied[key] = fields
+                self.verified.discard(key)
+            elif kind == _VERIFIED:
+                self.verified.add(key)
+            elif kind == _INVALIDATED:
+                self.copied.pop(key, None)
+                self.verified.discard(key)
+
+        return None
+
+    def completed(self, relative: str, st: stat_result) -> bool:
+        """ Return whether the file at the relative path was copied from a source with the same size, mtime and inode. """
+
+        entry = self.copied.get(relative)
+
+        return entry is not None and entry[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def payload(self, relative: str) -> Any:
+        return self.copied[relative][3]
+
+    def is_verified(self, key: str) -> bool:
+        return key in self.verified
+
+    def _append(self, line: list) -> None:
+        """ Queue an entry. A journal that cannot be written never fails the copy, it only loses entries. """
+
+        with self._lock:
+            self._lines.append(dumps(line, separators=(",", ":")))
+            full = len(self._lines) >= JOURNAL_FLUSH_ENTRIES
+
+        if full:
+            ret = self.flush()
+            if isinstance(ret, Error) and self.error is None:
+                self.error = ret
+
+    def record_copy(self, relative: str, st: stat_result, payload: Any=None) -> None:
+        """ Journal a file written in place, with an optional payload (a digest, a snapshot entry, ...) to restore when resuming. """
+
+        self.verified.discard(relative)
+        self._append([_COPIED, relative, st.st_size, st.st_mtime_ns, st.st_ino, payload])
+
+    def record_verified(self, key: str) -> None:
+        self._append([_VERIFIED, key])
+
+    def record_invalid(self, key: str) -> None:
+        """ Journal a file or object that failed verification, so it is not trusted when resuming. """
+
+        self.copied.pop(key, None)
+        self.verified.discard(key)
+        self._append([_INVALIDATED, key])
+
+    def _flush(self) -> None:
+        """ Must be called with the lock held. """
+
+        if not self._lines:
+            return
+
+        text = "\n".join(self._lines) + "\n"
+        self._lines.clear()
+
+        makedirs(dirname(self.path), exist_ok=True)
+        created = not exists(self.path)
+        with open(self.path, "a") as f:
+            f.write(text)
+            f.flush()
+            datasync(f.fileno()) # A checkpoint only counts once it survives a power loss
+
+        if created:
+            sync_directory(dirname(self.path))
+
+    def flush(self) -> None | Error:
+        """ Append the pending entries to the journal.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        try:
+            with self._lock:
+                self._flush()
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to write journal '{self.path}', an interrupted run may copy more files again.\nErr: {exc}{Colors.RESET}", exc)
+
+        return None
+
+    def remove(self) -> None | Error:
+        """ Discard the journal of a completed run.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        with self._lock:
+            self._lines.clear()
+
+        try:
+            unlink(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to remove journal '{self.path}'.\nErr: {exc}{Colors.RESET}", exc)
+
+        return None
@@ -1,3 +1,166 @@
+from constants import LOG_FLUSH_INTERVAL, LOG_MAX_BUFFERED_LINES, PROGRESS_INTERVAL
+from colors import Colors
+
+from typing import Any, TextIO
+from sys import stdout
+from threading import Event, Lock, Thread
+from time import monotonic
+from atexit import register
+
+DEBUG = 10 # Per-file lines
+INFO = 20
+
+class Logger:
+    """ Thread-safe line writer. Lines are written whole, so output of concurrent workers never interleaves.
+
+    Messages below the logger's level are dropped before their arguments are formatted.
+    While buffering, lines are collected and written in batches, at most every `LOG_FLUSH_INTERVAL` seconds or `LOG_MAX_BUFFERED_LINES` lines. """
+
+    def __init__(self, stream: TextIO | None=None, level: int=INFO) -> None:
+        self.stream = stream
+        self.level = level
+
+        self._lock = Lock()
+        self._lines: list[str] = []
+        self._buffering = 0 # Number of active `Progress` objects
+        self._last_flush = monotonic()
+
+    def write(self, line: str) -> None:
+        with self._lock:
+            self._lines.append(line)
+
+            if not self._buffering or len(self._lines) >= LOG_MAX_BUFFERED_LINES or monotonic() - self._last_flush >= LOG_FLUSH_INTERVAL:
+                self._flush()
+
+    def log(self, level: int, msg: str, *args: Any) -> None:
+        if level < self.level:
+            return
+
+        self.write(msg % args if args else msg)
+
+    def _flush(self) -> None:
+        """ Must be called with the lock held. """
+
+        if self._lines:
+            text = "\n".join(self._lines) + "\n"
+            self._lines.clear() # Dropped even if the write fails, so a closed stream does not fail every later write
+
+            stream = self.stream or stdout # Looked up on every flush, so redirections of sys.stdout are honored
+            stream.write(text)
+            stream.flush()
+
+        self._last_flush = monotonic()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def set_buffering(self, enabled: bool) -> None:
+        """ Start or stop collecting lines in batches. Calls nest, lines are written immediately again once every caller stopped. """
+
+        with self._lock:
+            self._buffering += 1 if enabled else -1
+            if not self._buffering:
+                self._flush()
+
+logger = Logger()
+register(logger.flush)
+
+def set_level(level: int) -> None:
+    logger.level = level
+
+def is_enabled(level: int) -> bool:
+    return level >= logger.level
+
+def debug(msg: str, *args: Any) -> None:
+    """ Log a per-file message, formatted with the `%` operator only if debug output is enabled. """
+
+    logger.log(DEBUG, msg, *args)
+
 def log(msg: str, quiet: bool=False) -> None:
     if not quiet:
-        print(msg)
+        logger.write(msg)
+
+def format_size(size: int) -> str:
+    """ Return a human readable representation of a size in bytes. """
+
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if size < 1024 or unit == "TiB":
+            break
+
+        size /= 1024
+
+    return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+class Progress:
+    """ Periodic summary of a long phase: files and bytes done, their rates and, once the totals are known, an estimated time left.
+
+    Replaces per-file log lines, which are only written at the debug level. Also buffers log lines while the phase runs. """
+
+    def __init__(self, label: str, quiet: bool, interval: float=PROGRESS_INTERVAL) -> None:
+        self.label = label
+        self.quiet = quiet
+        self.interval = interval
+
+        self.files = 0
+        self.size = 0
+        self.total_files: int | None = None # Unknown until set
+        self.total_size: int | None = None
+
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread: Thread | None = None
+        self._started = monotonic()
+
+    def update(self, size: int=0, files: int=1) -> None:
+        with self._lock:
+            self.files += files
+            self.size += size
+
+    def set_total(self, files: int | None, size: int | None=None) -> None:
+        self.total_files, self.total_size = files, size
+
+    def summary(self, final: bool=False) -> str:
+        elapsed = max(monotonic() - self._started, 1e-9)
+        files, size = self.files, self.size
+
+        line = f"{self.label}: {files} files ({format_size(size)}), {files / elapsed:.0f} files/s, {format_size(int(size / elapsed))}/s"
+
+        if not final: # Prefer bytes to estimate the time left, a few large files take longer than many small ones
+            if self.total_size and size:
+                line += f", ETA {format_duration(elapsed * max(self.total_size - size, 0) / size)}"
+            elif self.total_files and files:
+                line += f", ETA {format_duration(elapsed * max(self.total_files - files, 0) / files)}"
+
+        return line
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            log(f"{Colors.BRIGHT_BLACK}{self.summary()}{Colors.RESET}", self.quiet)
+            logger.flush()
+
+    def start(self) -> "Progress":
+        self._started = monotonic()
+        logger.set_buffering(True)
+
+        self._thread = Thread(target=self._run, name=f"progress-{self.label}", daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self) -> None:
+        """ Stop reporting and write the final summary. """
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        logger.set_buffering(False)
+        log(f"{self.summary(final=True)} in {format_duration(monotonic() - self._started)}", self.quiet or not self.files)
@@ -0,0 +1,117 @@
+from constants import METADATA_DIR_NAME, MANIFEST_FILE_NAME, MANIFEST_VERSION, HASH_SHA256
+from error import Error
+from colors import Colors
+
+from os import stat_result, makedirs, replace
+from os.path import join, dirname
+from json import load, dump, JSONDecodeError
+
+class ManifestEntry:
+    """ Metadata of a single source file at the time it was last copied. """
+
+    __slots__ = ("size", "mtime_ns", "inode", "digest")
+
+    def __init__(self, size: int, mtime_ns: int, inode: int, digest: str | None=None) -> None:
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+        self.digest = digest
+
+    def matches(self, st: stat_result) -> bool:
+        """ Return whether the given stat result describes the same, unmodified file. """
+
+        return self.size == st.st_size and self.mtime_ns == st.st_mtime_ns and self.inode == st.st_ino
+
+class Manifest:
+    """ Persistent record of the files copied by a rule, stored at the rule's destination.
+
+    Entries are keyed by the file path relative to the rule's source directory. """
+
+    def __init__(self, destination: str, algorithm: str) -> None:
+        self.path = join(destination, METADATA_DIR_NAME, MANIFEST_FILE_NAME)
+        self.algorithm = algorithm # Of the stored digests
+        self.entries: dict[str, ManifestEntry] = {}
+        self._seen: set[str] = set()
+
+    def load(self) -> None | Error:
+        """ Load the manifest from disk. A missing manifest is treated as an empty one.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        try:
+            with open(self.path) as f:
+                content = load(f)
+        except FileNotFoundError:
+            return None
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to open manifest '{self.path}' due to error:\n{exc}{Colors.RESET}", exc)
+        except JSONDecodeError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to parse manifest '{self.path}' due to error:\n{exc}{Colors.RESET}", exc)
+
+        if not isinstance(content, dict) or content.get("version") != MANIFEST_VERSION or not isinstance(content.get("files"), dict):
+            return Error(f"{Colors.BRIGHT_RED}Manifest '{self.path}' has an unsupported structure. Remove it to start a full copy.{Colors.RESET}")
+
+        try:
+            self.entries = {relative: ManifestEntry(*fields) for relative, fields in content["files"].items()}
+        except TypeError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Manifest '{self.path}' contains malformed entries. Remove it to start a full copy.{Colors.RESET}", exc)
+
+        if content.get("algorithm", HASH_SHA256) != self.algorithm: # The rule's hash algorithm changed, stored digests are meaningless now
+            for entry in self.entries.values():
+                entry.digest = None
+
+        return None
+
+    def save(self, prune: bool=False) -> None | Error:
+        """ Atomically write the manifest to disk.
+
+        If prune is set, entries for files that were not seen during this run are dropped.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        if prune:
+            self.entries = {relative: entry for relative, entry in self.entries.items() if relative in self._seen}
+
+        content = {
+            "version": MANIFEST_VERSION,
+            "algorithm": self.algorithm,
+            "files": {relative: [entry.size, entry.mtime_ns, entry.inode, entry.digest] for relative, entry in self.entries.items()}
+        }
+        tmp_path = f"{self.path}.tmp"
+
+        try:
+            makedirs(dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                dump(content, f, separators=(",", ":"))
+
+            replace(tmp_path, self.path)
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to write manifest '{self.path}' due to error:\n{exc}{Colors.RESET}", exc)
+
+        return None
+
+    def is_unchanged(self, relative: str, st: stat_result) -> bool:
+        """ Return whether the file at the relative path is unchanged since it was last recorded. """
+
+        self._seen.add(relative)
+        entry = self.entries.get(relative)
+
+        return entry is not None and entry.matches(st)
+
+    def record(self, relative: str, st: stat_result, digest: str | None=None) -> None:
+        """ Record the metadata of a freshly copied file. """
+
+        self._seen.add(relative)
+        self.entries[relative] = ManifestEntry(st.st_size, st.st_mtime_ns, st.st_ino, digest)
+
+    def discard(self, relative: str) -> None:
+        """ Forget a file, so the next run copies it again. Used for copies that failed verification. """
+
+        self.entries.pop(relative, None)
+
+    def set_digest(self, relative: str, digest: str) -> None:
+        """ Store the verified content hash of an already recorded file. """
+
+        entry = self.entries.get(relative)
+        if entry is not None:
+            entry.digest = digest
@@ -0,0 +1,48 @@
+from re import compile as re_compile, Pattern
+from fnmatch import translate
+from os.path import normcase
+
+_MAGIC_CHARS = frozenset("*?[")
+
+class IgnoreMatcher:
+    """ Match file names against a list of glob patterns, with the same results as `fnmatch.fnmatch`. 
+    
+    The patterns are compiled once: plain names go in a set, `*suffix` patterns go in per-length suffix sets,
+    and everything else is merged into a single regular expression. A lookup never loops over the patterns. """
+
+    def __init__(self, patterns: list[str]) -> None:
+        self.patterns = patterns
+
+        self._literals: set[str] = set()
+        self._suffixes: dict[int, set[str]] = {}
+        complex_patterns = []
+
+        for pattern in patterns:
+            pattern = normcase(pattern)
+
+            if not _MAGIC_CHARS.intersection(pattern):
+                self._literals.add(pattern)
+            elif pattern[0] == "*" and not _MAGIC_CHARS.intersection(pattern[1:]):
+                self._suffixes.setdefault(len(pattern) - 1, set()).add(pattern[1:])
+            else:
+                complex_patterns.append(pattern)
+
+        self._suffix_lengths = sorted(self._suffixes.items())
+        self._regex: Pattern[str] | None = re_compile("|".join(translate(pattern) for pattern in complex_patterns)) if complex_patterns else None
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def matches(self, name: str) -> bool:
+        """ Return whether the file or directory name matches any of the patterns. """
+
+        name = normcase(name)
+
+        if name in self._literals:
+            return True
+
+        for length, suffixes in self._suffix_lengths:
+            if name[len(name) - length:] in suffixes:
+                return True
+
+        return self._regex is not None and self._regex.match(name) is not None
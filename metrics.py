@@ -0,0 +1,108 @@
+from constants import METRICS_FORMAT_PROMETHEUS, METRICS_PREFIX, SIZE_BUCKETS
+from error import Error
+from colors import Colors
+
+from typing import Generator
+from contextlib import contextmanager
+from json import dumps
+from os import makedirs, replace
+from os.path import dirname, abspath
+from threading import Lock
+from time import perf_counter, time
+
+def size_bucket(size: int) -> str:
+    """ Return the label of the `SIZE_BUCKETS` range a file size falls in. """
+
+    for limit, label in SIZE_BUCKETS:
+        if size < limit:
+            return label
+
+    return SIZE_BUCKETS[-1][1]
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class Metrics:
+    """ Phase timings and counters of a run, safe to update from worker threads.
+
+    Every sample has a name and a set of labels (phase, rule, size bucket, ...). Names ending with `_total` are counters that only grow during a run,
+    everything else is a gauge holding the last value set. """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._values: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+
+    def add(self, name: str, value: float=1, **labels: str) -> None:
+        """ Increase a counter. """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """ Set a gauge. """
+
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def get(self, name: str, **labels: str) -> float:
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))), 0)
+
+    @contextmanager
+    def phase(self, name: str, **labels: str) -> Generator[None, None, None]:
+        """ Time the enclosed block and record its duration in seconds as the `phase_seconds` gauge, even if it raises. """
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.set("phase_seconds", perf_counter() - start, phase=name, **labels)
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        """ Return every sample as a (name, labels, value) tuple, sorted by name and labels. """
+
+        with self._lock:
+            return [(name, dict(labels), value) for (name, labels), value in sorted(self._values.items())]
+
+    def _to_jsonl(self, timestamp: float) -> str:
+        return "".join(dumps({"time": timestamp, "name": name, "labels": labels, "value": value}) + "\n" for name, labels, value in self.samples())
+
+    def _to_prometheus(self, timestamp: float) -> str:
+        lines = []
+        typed = set()
+
+        for name, labels, value in [*self.samples(), ("last_run_timestamp_seconds", {}, timestamp)]:
+            full_name = f"{METRICS_PREFIX}_{name}"
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append(f"# TYPE {full_name} {'counter' if name.endswith('_total') else 'gauge'}")
+
+            label_str = ",".join(f"{key}=\"{_escape_label(label)}\"" for key, label in labels.items())
+            lines.append(f"{full_name}{{{label_str}}} {value}" if label_str else f"{full_name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, format: str) -> None | Error:
+        """ Write the samples to path. JSON lines are appended, one object per sample, so a file keeps the history of every run.
+        A Prometheus textfile is atomically replaced, for the node exporter's textfile collector.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        timestamp = time()
+
+        try:
+            makedirs(dirname(abspath(path)), exist_ok=True)
+
+            if format == METRICS_FORMAT_PROMETHEUS:
+                with open(f"{path}.tmp", "w") as f:
+                    f.write(self._to_prometheus(timestamp))
+
+                replace(f"{path}.tmp", path)
+            else:
+                with open(path, "a") as f:
+                    f.write(self._to_jsonl(timestamp))
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to write metrics to '{path}'.\nErr: {exc}{Colors.RESET}", exc)
+
+        return None
@@ -0,0 +1,92 @@
+from constants import PLAN_LARGEST_ITEMS
+from colors import Colors
+from logutils import format_size, format_duration
+
+from heapq import heappush, heappushpop, nlargest
+from os import sep
+
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+class TransferPlan:
+    """ What a run of a rule would copy, out of a stat-only scan of its source made by a dry run.
+
+    Only the counters, the `PLAN_LARGEST_ITEMS` largest files and the size of each top-level folder are kept, not the scanned files. """
+
+    def __init__(self, source: str, destination: str, copies_unchanged: bool) -> None:
+        self.source = source
+        self.destination = destination
+        self.copies_unchanged = copies_unchanged # Rules that are not incremental copy every file
+
+        self.files = {NEW: 0, CHANGED: 0, UNCHANGED: 0}
+        self.sizes = {NEW: 0, CHANGED: 0, UNCHANGED: 0}
+        self.errors = 0
+
+        self._largest: list[tuple[int, str]] = [] # Min-heap of the largest files to copy
+        self._folders: dict[str, int] = {} # Top-level folder -> bytes to copy
+
+    def add(self, relative: str, size: int, status: str) -> None:
+        self.files[status] += 1
+        self.sizes[status] += size
+
+        if status == UNCHANGED and not self.copies_unchanged:
+            return
+
+        if len(self._largest) < PLAN_LARGEST_ITEMS:
+            heappush(self._largest, (size, relative))
+        else:
+            heappushpop(self._largest, (size, relative))
+
+        folder, separator, _ = relative.partition(sep)
+        if separator:
+            self._folders[folder] = self._folders.get(folder, 0) + size
+
+    @property
+    def files_to_copy(self) -> int:
+        return sum(self.files.values()) if self.copies_unchanged else self.files[NEW] + self.files[CHANGED]
+
+    @property
+    def bytes_to_copy(self) -> int:
+        return sum(self.sizes.values()) if self.copies_unchanged else self.sizes[NEW] + self.sizes[CHANGED]
+
+    def largest_files(self) -> list[tuple[int, str]]:
+        return sorted(self._largest, reverse=True)
+
+    def largest_folders(self) -> list[tuple[int, str]]:
+        return nlargest(PLAN_LARGEST_ITEMS, ((size, folder) for folder, size in self._folders.items()))
+
+    def summary(self, copy_seconds: float | None, verify_seconds: float | None, verifies: bool=True) -> str:
+        """ Return a multi-line report of the plan, with the estimated durations of the copy and the verification if known.
+
+        verifies tells whether the run would verify hashes at all. """
+
+        lines = [f"Plan for {self.source} -> {self.destination}:"]
+
+        counts = ", ".join(f"{status}: {self.files[status]} files ({format_size(self.sizes[status])})" for status in (NEW, CHANGED, UNCHANGED))
+        if self.copies_unchanged and self.files[UNCHANGED]:
+            counts += ", copied anyway since the rule is not incremental"
+        lines.append(f"  {counts}")
+
+        line = f"  {Colors.BRIGHT_CYAN}to copy: {self.files_to_copy} files ({format_size(self.bytes_to_copy)}){Colors.RESET}"
+        if copy_seconds is None:
+            line += ", no previous run recorded to estimate the duration"
+        else:
+            line += f", estimated copy {format_duration(copy_seconds)}"
+            if not verifies:
+                line += ", hash verification disabled"
+            elif verify_seconds is None:
+                line += ", verification time unknown"
+            else:
+                line += f", verification {format_duration(verify_seconds)}"
+        lines.append(line)
+
+        if self.errors:
+            lines.append(f"  {Colors.BRIGHT_YELLOW}{self.errors} entries could not be scanned{Colors.RESET}")
+
+        for title, items, suffix in (("largest files", self.largest_files(), ""), ("largest folders", self.largest_folders(), sep)):
+            if items:
+                lines.append(f"  {title}:")
+                lines.extend(f"    {format_size(size):>10}  {name}{suffix}" for size, name in items)
+
+        return "\n".join(lines)
@@ -0,0 +1,101 @@
+from constants import METADATA_DIR_NAME, TEMP_SUFFIX, PARTIAL_SUFFIX
+from matcher import IgnoreMatcher
+from walker import walk
+
+from typing import Callable, Generator, Iterator
+from os import DirEntry, unlink, sep
+from os.path import join, isdir, islink, lexists
+from shutil import rmtree
+
+def _keyed(entries: Iterator[tuple[str, DirEntry]]) -> Generator[tuple[tuple[str, ...], DirEntry], None, None]:
+    """ Key every entry of a sorted walk by its path components, the order in which the walk yields them. """
+
+    for relative_dir, entry in entries:
+        yield (*relative_dir.split(sep), entry.name) if relative_dir else (entry.name,), entry
+
+def is_own_file(key: tuple[str, ...]) -> bool:
+    """ Return whether a destination entry, given by its path components, was written by this program rather than copied from the source. """
+
+    name = key[-1]
+
+    return (len(key) == 1 and name == METADATA_DIR_NAME) or (name.startswith(".") and (name.endswith(TEMP_SUFFIX) or name.endswith(PARTIAL_SUFFIX)))
+
+def stale_entries(source: str, destination: str, matcher: IgnoreMatcher | None=None, follow_symlinks: bool=True, on_error: Callable[[str, OSError], None] | None=None) -> Generator[DirEntry, None, None]:
+    """ Yield the entries of destination that have no counterpart in source, by merging sorted walks of both trees.
+
+    Only the listings of the current path are kept in memory, never a set of either tree. The contents of a stale directory are not walked,
+    since removing the directory removes them too. Entries matching the matcher are never yielded, neither are the program's own state, temporary and partial files.
+    The destination's symlinks are never followed.
+
+    Errors on source directories are raised, so a directory that could not be listed never makes its destination counterpart look stale.
+    Errors on destination directories are passed to on_error if given, otherwise raised. """
+
+    not_walked: set[str] = set()
+
+    def _descend(entry: DirEntry) -> bool:
+        if entry.path in not_walked:
+            not_walked.remove(entry.path)
+            return False
+
+        return True
+
+    sources = _keyed(walk(source, matcher, follow_symlinks, sort=True))
+    source_key = next(sources, (None, None))[0]
+
+    for key, entry in _keyed(walk(destination, matcher, False, sort=True, on_error=on_error, descend=_descend)):
+        own = is_own_file(key)
+        if not own:
+            while source_key is not None and source_key < key:
+                source_key = next(sources, (None, None))[0]
+
+        stale = not own and source_key != key # Otherwise present in both trees, even if one is a file and the other a directory
+
+        if (own or stale) and entry.is_dir(follow_symlinks=False):
+            not_walked.add(entry.path)
+        if stale:
+            yield entry
+
+def _source_name(name: str) -> str | None:
+    """ Return the name of the source file a temporary or partial file was written for, or `None` for other files. """
+
+    if not name.startswith("."):
+        return None
+    elif name.endswith(TEMP_SUFFIX): # .<name><suffix>
+        return name[1:-len(TEMP_SUFFIX)] or None
+    elif name.endswith(PARTIAL_SUFFIX): # .<name>.<size>-<mtime><suffix>
+        stem, separator, _ = name[1:-len(PARTIAL_SUFFIX)].rpartition(".")
+        return stem if separator and stem else None
+
+    return None
+
+def stale_temp_files(source: str, destination: str, matcher: IgnoreMatcher | None=None, on_error: Callable[[str, OSError], None] | None=None) -> Generator[str, None, None]:
+    """ Yield the paths of the temporary and partial files of destination whose source file no longer exists or is now ignored.
+
+    They are left by crashed runs, and are never removed by pruning nor replaced by a later copy. The destination's symlinks are never followed,
+    and the program's own state is not walked. Errors on destination directories are passed to on_error if given, otherwise raised. """
+
+    metadata_dir = join(destination, METADATA_DIR_NAME)
+
+    for relative_dir, entry in walk(destination, follow_symlinks=False, on_error=on_error, descend=lambda entry: entry.path != metadata_dir):
+        name = _source_name(entry.name)
+        if name is None or entry.is_dir(follow_symlinks=False):
+            continue
+
+        if (matcher and matcher.matches(name)) or not lexists(join(source, relative_dir, name)):
+            yield entry.path
+
+def remove_entry(entry: DirEntry) -> None:
+    """ Remove a destination file, symlink or directory tree. """
+
+    if entry.is_dir(follow_symlinks=False):
+        rmtree(entry.path)
+    else:
+        unlink(entry.path)
+
+def remove_path(path: str) -> None:
+    """ Remove a destination file, symlink or directory tree that was not listed by a walk. """
+
+    if isdir(path) and not islink(path):
+        rmtree(path)
+    else:
+        unlink(path)
@@ -1,4 +1,6 @@
+from constants import FORMAT_MIRROR, FORMATS, DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS, COMPRESSIONS, DEFAULT_COMPRESSION
 from error import Error
+from matcher import IgnoreMatcher
 from colors import Colors
 from logutils import log
 
@@ -9,10 +11,17 @@ from typing import Any
 class Rule:
     """ Generic rule object to cache properties for each transfer. """
     
-    def __init__(self, source: str, destination: str, ignore: list[str]) -> None:
+    def __init__(self, source: str, destination: str, ignore: list[str], incremental: bool=False, matcher: IgnoreMatcher | None=None, format: str=FORMAT_MIRROR, hash_algorithm: str=DEFAULT_HASH_ALGORITHM, delta: bool=False, prune: bool=False, compression: str=DEFAULT_COMPRESSION) -> None:
         self.source = source
         self.destination = destination
         self.ignore = ignore
+        self.incremental = incremental
+        self.matcher = matcher if matcher is not None else IgnoreMatcher(ignore) # Shared by the copy and the hash verification walks
+        self.format = format
+        self.hash_algorithm = hash_algorithm
+        self.delta = delta # Only rewrite the changed blocks of large files that already exist at the destination
+        self.prune = prune # Remove destination files whose source was deleted
+        self.compression = compression # Only for rules using the archive format
 
 class RulesParser:
     def __init__(self, rules_file_path: str) -> None:
@@ -104,6 +113,78 @@ class RulesParser:
 
         return ignore_list
 
+    def _check_incremental(self, incremental: bool | None, iteration_count: int) -> bool | Error:
+        """ Check the incremental flag.
+
+        Return the flag if checks are passed, otherwise an `Error` object. """
+
+        if incremental is None:
+            return False
+        elif not isinstance(incremental, bool):
+            return Error(f"{Colors.BRIGHT_RED}Incremental attribute is defined as {incremental.__class__.__name__} at iteration {iteration_count}, expected boolean.{Colors.RESET}")
+
+        return incremental
+
+    def _check_delta(self, delta: bool | None, iteration_count: int) -> bool | Error:
+        """ Check the delta flag.
+
+        Return the flag if checks are passed, otherwise an `Error` object. """
+
+        if delta is None:
+            return False
+        elif not isinstance(delta, bool):
+            return Error(f"{Colors.BRIGHT_RED}Delta attribute is defined as {delta.__class__.__name__} at iteration {iteration_count}, expected boolean.{Colors.RESET}")
+
+        return delta
+
+    def _check_prune(self, prune: bool | None, iteration_count: int) -> bool | Error:
+        """ Check the prune flag.
+
+        Return the flag if checks are passed, otherwise an `Error` object. """
+
+        if prune is None:
+            return False
+        elif not isinstance(prune, bool):
+            return Error(f"{Colors.BRIGHT_RED}Prune attribute is defined as {prune.__class__.__name__} at iteration {iteration_count}, expected boolean.{Colors.RESET}")
+
+        return prune
+
+    def _check_format(self, destination_format: str | None, iteration_count: int) -> str | Error:
+        """ Check the destination format.
+
+        Return the format if checks are passed, otherwise an `Error` object. """
+
+        if destination_format is None:
+            return FORMAT_MIRROR
+        elif destination_format not in FORMATS:
+            return Error(f"{Colors.BRIGHT_RED}Format attribute at iteration {iteration_count} must be one of {', '.join(FORMATS)}.{Colors.RESET}")
+
+        return destination_format
+
+    def _check_compression(self, compression: str | None, iteration_count: int) -> str | Error:
+        """ Check the compression of archives.
+
+        Return the compression if checks are passed, otherwise an `Error` object. """
+
+        if compression is None:
+            return DEFAULT_COMPRESSION
+        elif compression not in COMPRESSIONS:
+            return Error(f"{Colors.BRIGHT_RED}Compression attribute at iteration {iteration_count} must be one of {', '.join(COMPRESSIONS)}.{Colors.RESET}")
+
+        return compression
+
+    def _check_hash_algorithm(self, hash_algorithm: str | None, iteration_count: int) -> str | Error:
+        """ Check the hash algorithm.
+
+        Return the algorithm if checks are passed, otherwise an `Error` object. """
+
+        if hash_algorithm is None:
+            return DEFAULT_HASH_ALGORITHM
+        elif hash_algorithm not in HASH_ALGORITHMS:
+            return Error(f"{Colors.BRIGHT_RED}Hash attribute at iteration {iteration_count} must be one of {', '.join(HASH_ALGORITHMS)}.{Colors.RESET}")
+
+        return hash_algorithm
+
     def parse_rules(self, content: dict[str, list[dict[str, Any]]]) -> list[Rule] | Error:
         """ Parse rules.json's content and return `Rule` objects. """
         
@@ -124,6 +205,12 @@ class RulesParser:
             source = rule.get("source")
             destination = rule.get("destination")
             ignore = rule.get("ignore")
+            incremental = rule.get("incremental")
+            destination_format = rule.get("format")
+            hash_algorithm = rule.get("hash")
+            delta = rule.get("delta")
+            prune = rule.get("prune")
+            compression = rule.get("compression")
 
             result = self._check_source_and_destination(source, destination, i+1)
             if isinstance(result, Error):
@@ -136,7 +223,41 @@ class RulesParser:
                 return result
             
             ignore_list = result
+
+            result = self._check_incremental(incremental, i+1)
+            if isinstance(result, Error):
+                return result
+
+            incremental = result
+
+            result = self._check_format(destination_format, i+1)
+            if isinstance(result, Error):
+                return result
+
+            destination_format = result
+
+            result = self._check_hash_algorithm(hash_algorithm, i+1)
+            if isinstance(result, Error):
+                return result
+
+            hash_algorithm = result
+
+            result = self._check_delta(delta, i+1)
+            if isinstance(result, Error):
+                return result
+
+            delta = result
+
+            result = self._check_prune(prune, i+1)
+            if isinstance(result, Error):
+                return result
+
+            prune = result
+
+            result = self._check_compression(compression, i+1)
+            if isinstance(result, Error):
+                return result
                 
-            rule_objs.append(Rule(source, destination, ignore_list))
+            rule_objs.append(Rule(source, destination, ignore_list, incremental, IgnoreMatcher(ignore_list), destination_format, hash_algorithm, delta, prune, result))
 
         return rule_objs
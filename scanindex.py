@@ -0,0 +1,48 @@
+from typing import Generator
+from array import array
+from os.path import join
+
+class ScanIndex:
+    """ Compact index of the files found while scanning a rule's source directory.
+
+    Entries are stored column-wise: sizes and mtimes in typed arrays, and paths as a directory id plus a name,
+    so every directory path is only stored once. Built in a single pass and shared by copy, verification and reporting. """
+
+    __slots__ = ("root", "_directories", "_directory_ids", "_names", "_sizes", "_mtimes", "total_size")
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self._directories: list[str] = []
+        self._directory_ids = array("I")
+        self._names: list[str] = []
+        self._sizes = array("q")
+        self._mtimes = array("q")
+        self.total_size = 0
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def add_directory(self, relative_dir: str) -> int:
+        """ Register a directory, relative to the root, and return its id. """
+
+        self._directories.append(relative_dir)
+        return len(self._directories) - 1
+
+    def add(self, directory_id: int, name: str, size: int, mtime_ns: int) -> None:
+        self._directory_ids.append(directory_id)
+        self._names.append(name)
+        self._sizes.append(size)
+        self._mtimes.append(mtime_ns)
+        self.total_size += size
+
+    def relative(self, i: int) -> str:
+        """ Return the path of entry i, relative to the root. """
+
+        directory = self._directories[self._directory_ids[i]]
+        return join(directory, self._names[i]) if directory else self._names[i]
+
+    def __iter__(self) -> Generator[tuple[str, int, int], None, None]:
+        """ Yield (relative path, size, mtime_ns) tuples in scan order. """
+
+        for i in range(len(self._names)):
+            yield self.relative(i), self._sizes[i], self._mtimes[i]
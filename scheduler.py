@@ -0,0 +1,65 @@
+from typing import Any, Callable, Hashable
+from collections import deque
+from threading import Condition
+from concurrent.futures import ThreadPoolExecutor
+
+class CopyScheduler:
+    """ Run jobs on a shared worker pool while limiting how many jobs touch the same device at once.
+
+    Jobs are grouped by a device key, usually the (source `st_dev`, destination `st_dev`) pair, so that a slow
+    spinning disk only ever sees a few concurrent streams while other devices keep the rest of the pool busy.
+
+    Jobs are expected to handle their own errors. """
+
+    def __init__(self, workers: int, per_device: int) -> None:
+        self.workers = max(1, workers)
+        self.per_device = max(1, per_device)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._lock = Condition()
+        self._queues: dict[Hashable, deque[tuple[Callable[..., Any], tuple[Any, ...]]]] = {}
+        self._running: dict[Hashable, int] = {}
+        self._pending = 0 # Queued and running jobs
+        self._max_pending = self.workers * 64 # Blocks the producer so a huge tree does not queue millions of jobs
+
+    def submit(self, device: Hashable, fn: Callable[..., Any], *args: Any) -> None:
+        """ Queue a job for the given device. Blocks while too many jobs are pending. """
+
+        with self._lock:
+            while self._pending >= self._max_pending:
+                self._lock.wait()
+
+            self._pending += 1
+            self._queues.setdefault(device, deque()).append((fn, args))
+            self._running.setdefault(device, 0)
+            self._dispatch(device)
+
+    def _dispatch(self, device: Hashable) -> None:
+        """ Hand queued jobs of a device to the pool until its concurrency limit is reached. Must be called with the lock held. """
+
+        queue = self._queues[device]
+        while queue and self._running[device] < self.per_device:
+            fn, args = queue.popleft()
+            self._running[device] += 1
+            self._executor.submit(self._run, device, fn, args)
+
+    def _run(self, device: Hashable, fn: Callable[..., Any], args: tuple[Any, ...]) -> None:
+        try:
+            fn(*args)
+        finally:
+            with self._lock:
+                self._running[device] -= 1
+                self._pending -= 1
+                self._dispatch(device)
+                self._lock.notify_all()
+
+    def join(self) -> None:
+        """ Wait until every submitted job has finished. """
+
+        with self._lock:
+            while self._pending:
+                self._lock.wait()
+
+    def shutdown(self) -> None:
+        self.join()
+        self._executor.shutdown()
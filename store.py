@@ -0,0 +1,156 @@
+from constants import STORE_OBJECTS_DIR_NAME, STORE_SNAPSHOTS_DIR_NAME, STORE_CHUNK_SIZE, SNAPSHOT_VERSION
+from error import Error
+from colors import Colors
+from hashing import ensure_regular
+
+from typing import Callable
+from hashlib import sha256
+from json import load, dump, JSONDecodeError
+from os import makedirs, replace, listdir, stat, stat_result, unlink
+from os.path import join, exists, dirname
+from threading import get_ident, local
+from datetime import datetime, timezone
+
+_buffers = local() # One reusable chunk buffer per thread
+
+def _chunk_buffer() -> memoryview:
+    view = getattr(_buffers, "view", None)
+    if view is None:
+        view = _buffers.view = memoryview(bytearray(STORE_CHUNK_SIZE))
+
+    return view
+
+class ObjectStore:
+    """ Content-addressed object store kept inside a destination directory.
+
+    Every object is a chunk of file data named after its SHA-256 hash, so identical data is only ever written once,
+    no matter how many files, rules or snapshots refer to it. Files larger than `STORE_CHUNK_SIZE` are split in several objects. """
+
+    def __init__(self, destination: str) -> None:
+        self.objects_dir = join(destination, STORE_OBJECTS_DIR_NAME)
+        self.snapshots_dir = join(destination, STORE_SNAPSHOTS_DIR_NAME)
+
+    def object_path(self, digest: str) -> str:
+        return join(self.objects_dir, digest[:2], digest[2:])
+
+    def has(self, digest: str) -> bool:
+        return exists(self.object_path(digest))
+
+    def discard(self, digest: str) -> None | Error:
+        """ Remove a corrupt object, so the next file holding its data writes it again instead of trusting it.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        try:
+            unlink(self.object_path(digest))
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to remove corrupt object '{self.object_path(digest)}', files holding its data stay damaged.\nErr: {exc}{Colors.RESET}", exc)
+
+        return None
+
+    def _write_object(self, digest: str, data: memoryview) -> None:
+        """ Atomically write an object. Concurrent writers of the same object write the same bytes, so the last rename wins harmlessly. """
+
+        path = self.object_path(digest)
+        tmp_path = f"{path}.{get_ident()}.tmp"
+
+        makedirs(dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+        replace(tmp_path, path)
+
+    def store_file(self, file_path: str, on_write: Callable[[str], None] | None=None) -> tuple[str, list[str], int]:
+        """ Split the file in chunks and write the chunks that are not in the store yet. The path of every written object is passed to on_write if given.
+
+        Raise `shutil.SpecialFileError` without opening the file if it is not a regular file.
+
+        Return a tuple with the file's SHA-256 hex digest, the digests of its chunks and the number of bytes actually written. """
+
+        ensure_regular(file_path, stat(file_path).st_mode)
+        file_hash = sha256()
+        chunks = []
+        written = 0
+        view = _chunk_buffer()
+
+        with open(file_path, "rb") as f: # Buffered reads fill whole chunks, so chunk boundaries only depend on the data
+            while True:
+                read = f.readinto(view)
+                if not read:
+                    break
+
+                chunk = view[:read]
+                file_hash.update(chunk)
+                digest = sha256(chunk).hexdigest()
+
+                if not self.has(digest):
+                    self._write_object(digest, chunk)
+                    written += read
+                    if on_write is not None:
+                        on_write(self.object_path(digest))
+
+                chunks.append(digest)
+
+        return file_hash.hexdigest(), chunks, written
+
+class Snapshot:
+    """ Manifest of one run of a rule into an `ObjectStore`: every file's metadata and the objects holding its data.
+
+    Snapshots of a rule live in their own directory, named after a hash of the rule's source, one JSON file per run. """
+
+    def __init__(self, store: ObjectStore, source: str) -> None:
+        self.source = source
+        self.directory = join(store.snapshots_dir, sha256(source.encode()).hexdigest()[:16])
+        self.files: dict[str, list] = {} # Relative path -> [size, mtime_ns, inode, mode, digest, chunk digests]
+
+    def load_latest(self) -> dict[str, list] | Error:
+        """ Return the files of the most recent snapshot of this rule, or an empty dict if there is none. Otherwise an `Error` object. """
+
+        try:
+            names = sorted(name for name in listdir(self.directory) if name.endswith(".json"))
+        except FileNotFoundError:
+            return {}
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to list snapshots in '{self.directory}' due to error:\n{exc}{Colors.RESET}", exc)
+
+        if not names:
+            return {}
+
+        path = join(self.directory, names[-1])
+        try:
+            with open(path) as f:
+                content = load(f)
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to open snapshot '{path}' due to error:\n{exc}{Colors.RESET}", exc)
+        except JSONDecodeError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to parse snapshot '{path}' due to error:\n{exc}{Colors.RESET}", exc)
+
+        if not isinstance(content, dict) or content.get("version") != SNAPSHOT_VERSION or not isinstance(content.get("files"), dict):
+            return Error(f"{Colors.BRIGHT_RED}Snapshot '{path}' has an unsupported structure.{Colors.RESET}")
+
+        return content["files"]
+
+    def add(self, relative: str, st: stat_result, digest: str, chunks: list[str]) -> None:
+        self.files[relative] = [st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode, digest, chunks]
+
+    def save(self) -> str | Error:
+        """ Atomically write the snapshot under a new, time-ordered name.
+
+        Return the snapshot path on success, otherwise an `Error` object. """
+
+        name = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        path = join(self.directory, f"{name}.json")
+        content = {"version": SNAPSHOT_VERSION, "source": self.source, "files": self.files}
+
+        try:
+            makedirs(self.directory, exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                dump(content, f, separators=(",", ":"))
+
+            replace(f"{path}.tmp", path)
+        except OSError as exc:
+            return Error(f"{Colors.BRIGHT_RED}Unable to write snapshot '{path}' due to error:\n{exc}{Colors.RESET}", exc)
+
+        return path
@@ -0,0 +1,113 @@
+from constants import DEFAULT_HASH_ALGORITHM
+from hashing import hash_file
+
+from typing import Callable, Iterable
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+class VerificationResult:
+    """ Outcome of the hash verification of a single source and destination file pair. """
+
+    __slots__ = ("source", "destination", "source_digest", "destination_digest", "error")
+
+    def __init__(self, source: str, destination: str) -> None:
+        self.source = source
+        self.destination = destination
+        self.source_digest: str | None = None
+        self.destination_digest: str | None = None
+        self.error: BaseException | None = None
+
+    @property
+    def matched(self) -> bool:
+        return self.error is None and self.source_digest is not None and self.source_digest == self.destination_digest
+
+class _PendingPair:
+    """ A pair whose source and destination hashes are still being computed. """
+
+    __slots__ = ("result", "remaining")
+
+    def __init__(self, result: VerificationResult) -> None:
+        self.result = result
+        self.remaining = 1 if result.source_digest is not None else 2
+
+class HashVerifier:
+    """ Hash many file pairs concurrently on a thread or process pool.
+    
+    The source and destination of each pair are hashed as two separate jobs, so they are read at the same time. """
+
+    def __init__(self, workers: int, use_processes: bool=False) -> None:
+        self.workers = max(1, workers)
+        self.use_processes = use_processes
+
+    def _make_executor(self) -> Executor:
+        if self.use_processes:
+            return ProcessPoolExecutor(max_workers=self.workers)
+        
+        return ThreadPoolExecutor(max_workers=self.workers) # hashlib releases the GIL while hashing large buffers
+
+    def verify(self, pairs: Iterable[tuple[str, str, str | None]], on_result: Callable[[VerificationResult], None] | None=None, algorithm: str=DEFAULT_HASH_ALGORITHM) -> VerificationResult | None:
+        """ Hash and compare every (source, destination, source digest) pair with the given algorithm.
+
+        When the source digest is already known (e.g. it was computed while copying) only the destination is read.
+        Results are only passed to on_result in completion order, never kept, so memory does not grow with the number of pairs.
+
+        Stops scheduling new work as soon as a pair fails to match or cannot be read.
+        
+        Return the result of the pair that failed, otherwise `None` if every pair matched. """
+
+        failed = None
+        in_flight: dict[Future, tuple[_PendingPair, bool]] = {}
+        max_in_flight = self.workers * 4 # Bounds memory when pairs is a large lazy iterable
+        pairs_iterator = iter(pairs)
+        exhausted = False
+
+        executor = self._make_executor()
+        try:
+            while True:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    pair = next(pairs_iterator, None)
+                    if pair is None:
+                        exhausted = True
+                        break
+
+                    src, dst, src_digest = pair
+                    result = VerificationResult(src, dst)
+                    result.source_digest = src_digest
+
+                    pending = _PendingPair(result)
+                    if src_digest is None:
+                        in_flight[executor.submit(hash_file, src, algorithm)] = (pending, True)
+                    in_flight[executor.submit(hash_file, dst, algorithm)] = (pending, False)
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending, is_source = in_flight.pop(future)
+                    result = pending.result
+
+                    exc = future.exception()
+                    if exc is not None:
+                        result.error = result.error or exc
+                    elif is_source:
+                        result.source_digest = future.result()
+                    else:
+                        result.destination_digest = future.result()
+
+                    pending.remaining -= 1
+                    if pending.remaining:
+                        continue
+
+                    if on_result is not None:
+                        on_result(result)
+
+                    if not result.matched:
+                        failed = result
+                        break
+
+                if failed is not None:
+                    break
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return failed
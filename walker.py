@@ -0,0 +1,129 @@
+from matcher import IgnoreMatcher
+
+from typing import Callable, Generator, Iterable, Iterator
+from os import scandir, DirEntry, sep
+from os.path import join, dirname, basename
+
+def _sorted_entries(path: str) -> Iterator[DirEntry]:
+    with scandir(path) as iterator:
+        return iter(sorted(iterator, key=lambda entry: entry.name))
+
+def walk(root: str, matcher: IgnoreMatcher | None=None, follow_symlinks: bool=True, sort: bool=False, on_error: Callable[[str, OSError], None] | None=None, on_ignore: Callable[[DirEntry], None] | None=None, descend: Callable[[DirEntry], bool] | None=None) -> Generator[tuple[str, DirEntry], None, None]:
+    """ Walk the tree under root without recursion and yield a (relative directory, entry) tuple for every entry that is not ignored.
+
+    Directories are yielded before their contents. Entries are yielded as soon as they are read, so consumers can start working before the walk ends.
+    Without sort, only a stack of pending directory paths is kept in memory and a single directory is open at a time.
+    With sort, entries of each directory are yielded by name and subdirectories are walked in place, which gives a stable depth-first order
+    at the cost of keeping one listing per level of the current path in memory.
+
+    Errors on root are raised. Errors on nested directories are passed to on_error if given, otherwise raised.
+    Entries skipped by the matcher are passed to on_ignore if given. The contents of an ignored directory are never read.
+    Directories for which descend returns False are yielded but not walked. It is called once the consumer is done with the directory's entry. """
+
+    def _handle_error(path: str, exc: OSError) -> None:
+        if path == root or on_error is None:
+            raise exc
+
+        on_error(path, exc)
+
+    if not sort:
+        pending = [("", root)]
+
+        while pending:
+            relative_dir, path = pending.pop()
+
+            try:
+                with scandir(path) as iterator:
+                    for entry in iterator:
+                        if matcher and matcher.matches(entry.name):
+                            if on_ignore is not None:
+                                on_ignore(entry)
+                            continue
+
+                        yield relative_dir, entry
+
+                        if entry.is_dir(follow_symlinks=follow_symlinks) and (descend is None or descend(entry)):
+                            pending.append((join(relative_dir, entry.name) if relative_dir else entry.name, entry.path))
+            except OSError as exc:
+                _handle_error(path, exc)
+
+        return
+
+    try:
+        stack = [("", _sorted_entries(root))]
+    except OSError as exc:
+        _handle_error(root, exc)
+        return
+
+    while stack:
+        relative_dir, entries = stack[-1]
+        entry = next(entries, None)
+
+        if entry is None:
+            stack.pop()
+            continue
+        elif matcher and matcher.matches(entry.name):
+            if on_ignore is not None:
+                on_ignore(entry)
+            continue
+
+        yield relative_dir, entry
+
+        if entry.is_dir(follow_symlinks=follow_symlinks) and (descend is None or descend(entry)):
+            try:
+                stack.append((join(relative_dir, entry.name) if relative_dir else entry.name, _sorted_entries(entry.path)))
+            except OSError as exc:
+                _handle_error(entry.path, exc)
+
+def walk_paths(root: str, relatives: Iterable[str], matcher: IgnoreMatcher | None=None, follow_symlinks: bool=True, on_error: Callable[[str, OSError], None] | None=None, on_missing: Callable[[str], None] | None=None) -> Generator[tuple[str, DirEntry], None, None]:
+    """ Walk only the given paths under root, relative to it, and yield (relative directory, entry) tuples like `walk`.
+
+    Paths that are directories are walked entirely. Each parent directory is listed once for all of its given paths.
+    Paths inside an ignored directory or inside another given directory are skipped. Paths that do not exist are passed to on_missing if given.
+    Errors are passed to on_error if given, otherwise raised. """
+
+    def _handle_error(path: str, exc: OSError) -> None:
+        if on_error is None:
+            raise exc
+
+        on_error(path, exc)
+
+    by_parent: dict[str, set[str]] = {}
+    for relative in relatives:
+        if relative and not (matcher and any(matcher.matches(part) for part in relative.split(sep))):
+            by_parent.setdefault(dirname(relative), set()).add(basename(relative))
+
+    walked: set[str] = set() # Given directories, whose whole tree was walked
+    for parent in sorted(by_parent): # Ancestors sort before their descendants
+        ancestor = parent
+        while ancestor and ancestor not in walked:
+            ancestor = dirname(ancestor)
+        if ancestor:
+            continue
+
+        names = by_parent[parent]
+        try:
+            with scandir(join(root, parent)) as iterator:
+                entries = sorted((entry for entry in iterator if entry.name in names), key=lambda entry: entry.name)
+        except FileNotFoundError:
+            entries = []
+        except OSError as exc:
+            _handle_error(join(root, parent), exc)
+            continue
+
+        if on_missing is not None:
+            for name in sorted(names.difference(entry.name for entry in entries)):
+                on_missing(join(parent, name) if parent else name)
+
+        for entry in entries:
+            yield parent, entry
+
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                relative = join(parent, entry.name) if parent else entry.name
+                walked.add(relative)
+
+                try:
+                    for relative_dir, child in walk(entry.path, matcher, follow_symlinks, on_error=on_error):
+                        yield join(relative, relative_dir) if relative_dir else relative, child
+                except OSError as exc:
+                    _handle_error(entry.path, exc)
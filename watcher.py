@@ -0,0 +1,194 @@
+from constants import FORMAT_STORE, WATCH_READ_SIZE
+from rulesparser import Rule
+from error import Error
+from colors import Colors
+from logutils import log, debug
+from walker import walk
+
+from errno import ENOENT, ENOTDIR, ENOSPC
+from os import fsencode, read, close, strerror, O_NONBLOCK, O_CLOEXEC
+from os.path import join
+from select import select
+from struct import Struct
+from time import monotonic
+
+try:
+    from ctypes import CDLL, c_int, c_char_p, c_uint32, get_errno
+    _libc = CDLL(None, use_errno=True) # Linux only, not exposed by the os module
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_init1.argtypes = (c_int,)
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = (c_int, c_char_p, c_uint32)
+    SUPPORTS_INOTIFY = True
+except (ImportError, OSError, AttributeError):
+    SUPPORTS_INOTIFY = False
+
+# From linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+_DIRECTORY_CHANGES = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE # Other events on directories only touch their own metadata
+_EVENT = Struct("iIII") # struct inotify_event without its name: wd, mask, cookie, len
+
+class SourceWatcher:
+    """ Watch the source trees of rules with inotify and collect the paths touched under them, relative to each rule's source.
+
+    Inotify is not recursive, so every directory of a source gets its own watch. Directories created or moved into a source are watched
+    as their events arrive. Ignored directories are never watched. Events are coalesced per rule into a set of paths, so a file written
+    many times is only copied once per batch. When the kernel's event queue overflows, events were lost and every rule is marked for a full pass instead.
+    Callers must check `SUPPORTS_INOTIFY`. """
+
+    def __init__(self, rules: list[Rule], no_follow_symlinks: bool) -> None:
+        self.rules = rules
+        self.no_follow_symlinks = no_follow_symlinks
+
+        self._fd = -1
+        self._watches: dict[int, list[tuple[Rule, str]]] = {} # Watch descriptor -> (rule, relative directory) pairs, sources may overlap
+        self._pending: dict[Rule, set[str] | None] = {} # Touched relative paths of each rule, None when the whole source has to be copied
+        self._first = 0.0 # When the first and last pending events were read
+        self._last = 0.0
+
+    @property
+    def directories(self) -> int:
+        return len(self._watches)
+
+    def _add_watch(self, rule: Rule, relative: str) -> None:
+        wd = _inotify_add_watch(self._fd, fsencode(join(rule.source, relative) if relative else rule.source), _WATCH_MASK)
+        if wd < 0:
+            errno = get_errno()
+            if errno in {ENOENT, ENOTDIR} and relative: # Deleted or replaced since it was listed, its parent reports it
+                return
+
+            message = "the limit of inotify watches was reached, raise fs.inotify.max_user_watches" if errno == ENOSPC else strerror(errno)
+            raise OSError(errno, message, join(rule.source, relative))
+
+        watches = self._watches.setdefault(wd, [])
+        watches[:] = [(watched, directory) for watched, directory in watches if watched is not rule] # The same inode keeps its descriptor when moved
+        watches.append((rule, relative))
+
+    def _watch_tree(self, rule: Rule, relative: str) -> None:
+        """ Watch a directory of the rule's source and every directory under it that is not ignored. """
+
+        follow_symlinks = not self.no_follow_symlinks or rule.format == FORMAT_STORE
+        self._add_watch(rule, relative)
+
+        def _on_walk_error(path: str, exc: OSError) -> None:
+            debug("Unable to watch %s: %s", path, exc)
+
+        for relative_dir, entry in walk(join(rule.source, relative) if relative else rule.source, rule.matcher, follow_symlinks, on_error=_on_walk_error):
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                name = join(relative_dir, entry.name) if relative_dir else entry.name
+                self._add_watch(rule, join(relative, name) if relative else name)
+
+    def start(self) -> None | Error:
+        """ Watch the source of every rule.
+
+        Return `None` on success, otherwise an `Error` object. """
+
+        self._fd = _inotify_init1(O_NONBLOCK | O_CLOEXEC)
+        if self._fd < 0:
+            errno = get_errno()
+            return Error(f"{Colors.BRIGHT_RED}Unable to start watching the sources.\nErr: {strerror(errno)}{Colors.RESET}", OSError(errno, strerror(errno)))
+
+        for rule in self.rules:
+            try:
+                self._watch_tree(rule, "")
+            except OSError as exc:
+                self.close()
+                return Error(f"{Colors.BRIGHT_RED}Unable to watch {rule.source} for changes.\nErr: {exc}{Colors.RESET}", exc)
+
+        return None
+
+    def _touch(self, rule: Rule, relative: str | None) -> None:
+        paths = self._pending.get(rule, set())
+        if paths is not None and relative is not None:
+            paths.add(relative)
+
+        self._pending[rule] = paths if relative is not None else None
+
+    def _handle(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            log(f"{Colors.BRIGHT_YELLOW}WARNING: Too many changes to keep track of, every source will be copied again.{Colors.RESET}")
+            for rule in self.rules:
+                self._touch(rule, None)
+
+            return
+        elif mask & IN_IGNORED: # Watched directory deleted or moved out of the filesystem
+            self._watches.pop(wd, None)
+            return
+        elif not name or (mask & IN_ISDIR and not mask & _DIRECTORY_CHANGES):
+            return
+
+        for rule, relative_dir in list(self._watches.get(wd, ())):
+            if rule.matcher.matches(name): # Ancestors are never watched when ignored
+                continue
+
+            relative = join(relative_dir, name) if relative_dir else name
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._watch_tree(rule, relative)
+                except OSError as exc: # Its changes are missed until a full pass
+                    log(f"{Colors.BRIGHT_YELLOW}WARNING: Unable to watch {join(rule.source, relative)} for changes.\nErr: {exc}{Colors.RESET}")
+
+            self._touch(rule, relative)
+
+    def _read_events(self, timeout: float | None) -> None:
+        """ Wait up to timeout seconds for events, forever if `None`, and collect every event that can be read without blocking. """
+
+        readable, _, _ = select([self._fd], [], [], timeout)
+        if not readable:
+            return
+
+        while True:
+            try:
+                data = read(self._fd, WATCH_READ_SIZE)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+                offset += length
+
+                if not self._pending:
+                    self._first = monotonic()
+
+                self._handle(wd, mask, name)
+
+        self._last = monotonic()
+
+    def wait_batch(self, debounce: float, max_delay: float) -> dict[Rule, set[str] | None]:
+        """ Block until a batch of changes is ready and return the touched paths of each rule, or `None` for rules to copy entirely.
+
+        A batch is ready once no event arrived for debounce seconds, or max_delay seconds after its first event so files that never stop changing are still copied. """
+
+        while True:
+            if self._pending:
+                now = monotonic()
+                deadline = min(self._last + debounce, self._first + max_delay)
+                if now >= deadline:
+                    batch, self._pending = self._pending, {}
+                    return batch
+
+                self._read_events(deadline - now)
+            else:
+                self._read_events(None)
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            close(self._fd) # Removes every watch
+            self._fd = -1
+
+        self._watches.clear()